@@ -1,9 +1,26 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta, date
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from contextlib import closing
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import sqlite3
 import time
+import threading
 import urllib.parse
+import uuid
+from sheets_standin import SheetStore
 
 # --- 1. SETUP & CONNECTION ---
 st.set_page_config(page_title="LAIKA PET MART", layout="wide")
@@ -61,6 +78,90 @@ st.markdown("""
 SCRIPT_URL = "https://script.google.com/macros/s/AKfycbxwaDEDI2pr0wO1293egYrMxwsj3F-R50Anxxn59mWkwGCCU5uclUYnSN1_ojEVSKqE/exec" 
 SHEET_LINK = "https://docs.google.com/spreadsheets/d/1HHAuSs4aMzfWT2SD2xEzz45TioPdPhTeeWK5jull8Iw/gviz/tq?tqx=out:csv&sheet="
 
+# Shared HTTP connection pool for Google reads and writes
+HTTP_POOL_SIZE = int(os.environ.get("LAIKA_HTTP_POOL_SIZE", "10"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("LAIKA_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("LAIKA_HTTP_READ_TIMEOUT", "15"))
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+@st.cache_resource
+def get_http_session():
+    """Keep-alive session reused by every request so TLS is negotiated once per host"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# --- STORAGE BACKENDS ---
+# Every read and write of the spreadsheet goes through one backend:
+#   google  - the live spreadsheet (default)
+#   sqlite  - a local SQLite file, in-process
+#   standin - sheets_standin.py served over HTTP, same protocol as Google
+STORAGE_BACKEND = os.environ.get("LAIKA_BACKEND", "google")
+STANDIN_URL = os.environ.get("LAIKA_STANDIN_URL", "http://127.0.0.1:8765")
+SQLITE_SHEETS_PATH = os.environ.get("LAIKA_SQLITE_SHEETS", "laika_sheets.db")
+
+class GoogleSheetsBackend:
+    """Reads through the gviz CSV endpoint, writes through the Apps Script"""
+    def __init__(self, sheet_link=SHEET_LINK, script_url=SCRIPT_URL):
+        self.sheet_link = sheet_link
+        self.script_url = script_url
+    
+    def read_csv(self, sheet_name, query=None):
+        """CSV text of a sheet or a gviz query - raises when it can't be had"""
+        url = f"{self.sheet_link}{urllib.parse.quote(sheet_name)}&cache={time.time()}"
+        if query:
+            url += "&tq=" + urllib.parse.quote(query)
+        response = get_http_session().get(url, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        if query and "csv" not in response.headers.get("Content-Type", ""):
+            # A query Google can't run comes back as an error page, not CSV
+            raise ValueError(f"Query failed on {sheet_name}")
+        return response.text
+    
+    def post(self, payload, sheet_name=None, idem_key=None):
+        """Send a row (with sheet_name) or an action to the Apps Script, return its reply.
+        The script answers a repeated idem_key with its first reply instead of writing again."""
+        params = {"sheet": sheet_name, "key": idem_key}
+        response = get_http_session().post(self.script_url, params={k: v for k, v in params.items() if v},
+                                           json=payload, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response.text.strip()
+
+class StandInBackend(GoogleSheetsBackend):
+    """The Google protocol, pointed at a local sheets_standin.py server"""
+    def __init__(self, base_url=STANDIN_URL):
+        base_url = base_url.rstrip("/")
+        super().__init__(f"{base_url}/gviz/tq?tqx=out:csv&sheet=", f"{base_url}/exec")
+
+class SQLiteBackend:
+    """Sheets kept in a local SQLite file, answered in-process"""
+    def __init__(self, path=SQLITE_SHEETS_PATH):
+        # Named headers, so empty sheets still come back with their columns like Google's
+        self.store = SheetStore(path, headers={name: [column for column, _ in schema]
+                                               for name, schema in SHEET_SCHEMAS.items()})
+    
+    def read_csv(self, sheet_name, query=None):
+        return self.store.read_csv(sheet_name, query)
+    
+    def post(self, payload, sheet_name=None, idem_key=None):
+        return self.store.handle_post(payload, sheet_name, idem_key)
+
+STORAGE_BACKENDS = {"google": GoogleSheetsBackend, "sqlite": SQLiteBackend, "standin": StandInBackend}
+
+@st.cache_resource
+def get_backend():
+    """The storage backend chosen with LAIKA_BACKEND"""
+    return STORAGE_BACKENDS[STORAGE_BACKEND]()
+
+def local_path(name):
+    """Local cache file name, kept apart per backend so their data never mixes"""
+    if STORAGE_BACKEND == "google":
+        return name
+    stem, ext = os.path.splitext(name)
+    return f"{stem}_{STORAGE_BACKEND}{ext}"
+
 # Initialize session states
 if 'bill_cart' not in st.session_state: 
     st.session_state.bill_cart = []
@@ -72,85 +173,1503 @@ if 'manual_cash' not in st.session_state:
     st.session_state.manual_cash = None
 if 'manual_online' not in st.session_state:
     st.session_state.manual_online = None
+if 'bill_cart_id' not in st.session_state:
+    st.session_state.bill_cart_id = uuid.uuid4().hex
+
+# Seconds a downloaded sheet stays fresh in the shared cache
+SHEET_CACHE_TTL = {
+    "Balances": 30,
+    "Inventory": 60,
+    "Bills": 60,
+    "BillHeaders": 60,
+    "CustomerKhata": 60,
+    "LoyaltyPoints": 60,
+    "Purchases": 120,
+    "Expenses": 120,
+    "Services": 120,
+    "SupplierDues": 120,
+    "HandInvestments": 300,
+    "Offers": 300,
+    "PetRegister": 300,
+    "StockLedger": 60,
+    "StockSnapshots": 300,
+    "ItemAliases": 300,
+    "ItemCodes": 300,
+}
+DEFAULT_CACHE_TTL = 120
+# Upper bound on parallel sheet downloads from one page render
+LOAD_MANY_WORKERS = 6
+
+# --- SHEET SCHEMAS ---
+# Column names and types of each sheet, in sheet order. Downloads are named and
+# typed against these once, so cached frames are ready to index by name.
+SHEET_SCHEMAS = {
+    "Bills": [("Date", "date"), ("Customer", "text"), ("Phone", "text"), ("Item", "text"),
+              ("Qty", "number"), ("Rate", "number"), ("Amount", "number"), ("BillID", "text")],
+    "BillHeaders": [("BillID", "text"), ("Date", "date"), ("Customer", "text"), ("Phone", "text"),
+                    ("Total", "number"), ("Discount", "number"), ("Redeemed", "number"), ("Final", "number"),
+                    ("Cash", "number"), ("Online", "number"), ("Due", "number"), ("Points", "number"),
+                    ("Cashier", "text")],
+    "Purchases": [("Date", "date"), ("Supplier", "text"), ("Phone", "text"), ("Item", "text"),
+                  ("Quantity", "text"), ("Amount", "number")],
+    "Inventory": [("Item", "text"), ("Qty", "number"), ("Unit", "text"), ("Rate", "number"), ("Date", "date")],
+    "Expenses": [("Date", "date"), ("Category", "text"), ("Amount", "number"), ("Remarks", "text")],
+    "CustomerKhata": [("Customer", "text"), ("Amount", "number")],
+    "SupplierDues": [("Supplier", "text"), ("Amount", "number"), ("Date", "date")],
+    "LoyaltyPoints": [("Customer", "text"), ("Points", "number"), ("Date", "date"), ("Reason", "text"), ("User", "text")],
+    "Services": [("Date", "date"), ("Customer", "text"), ("Phone", "text"), ("PetName", "text"), ("PetType", "text"),
+                 ("Service", "text"), ("Amount", "number"), ("Payment", "text"), ("Notes", "text"), ("User", "text")],
+    "Offers": [("Name", "text"), ("Type", "text"), ("Description", "text"), ("ValidFrom", "text"),
+               ("ValidTill", "text"), ("Status", "text"), ("CreatedBy", "text"), ("CreatedOn", "text")],
+    "PetRegister": [("Date", "date"), ("PetType", "text"), ("Breed", "text"), ("Color", "text"), ("Age", "text"),
+                    ("Customer", "text"), ("Phone", "text"), ("Price", "number"), ("Vaccine1", "text"),
+                    ("Vaccine1Date", "text"), ("Vaccine2", "text"), ("Vaccine2Date", "text")],
+    "Balances": [("Mode", "text"), ("Balance", "number")],
+    "HandInvestments": [("Name", "text"), ("Date", "date"), ("Amount", "number")],
+    "StockLedger": [("Date", "date"), ("Item", "text"), ("Change", "number"), ("Kind", "text"),
+                    ("Ref", "text"), ("User", "text")],
+    "StockSnapshots": [("Date", "date"), ("Item", "text"), ("Qty", "number"), ("LedgerRows", "number")],
+    "ItemAliases": [("Alias", "text"), ("Item", "text")],
+    "ItemCodes": [("Code", "text"), ("Item", "text"), ("SellingPrice", "number")],
+}
+
+def schema_position(sheet_name, column):
+    """Position of a named column in a sheet"""
+    return [name for name, _ in SHEET_SCHEMAS[sheet_name]].index(column)
+
+def schema_columns(sheet_name, kind):
+    """Names of a sheet's columns of one type ('text', 'number' or 'date')"""
+    return [name for name, col_kind in SHEET_SCHEMAS.get(sheet_name, []) if col_kind == kind]
+
+def to_dates(values):
+    """Parse a column of dd/mm/yyyy strings to dates, leaving parsed columns alone"""
+    present = values.dropna()
+    if present.empty or isinstance(present.iloc[0], date):
+        return values
+    return pd.to_datetime(values, errors='coerce', dayfirst=True).dt.date
+
+def apply_schema(sheet_name, df):
+    """Rename a sheet's columns by position and coerce their types once"""
+    df.columns = df.columns.str.strip()
+    schema = SHEET_SCHEMAS.get(sheet_name)
+    if schema is None:
+        date_col = next((c for c in df.columns if 'date' in c.lower()), None)
+        if date_col:
+            df[date_col] = to_dates(df[date_col])
+            df = df.rename(columns={date_col: 'Date'})
+        return df
+    
+    df = df.rename(columns=dict(zip(df.columns[:len(schema)], [name for name, _ in schema])))
+    for name, kind in schema:
+        if name not in df.columns:
+            # Short sheets still get every column, so pages can index by name
+            df[name] = float("nan") if kind == "number" else None
+        elif kind == "number":
+            df[name] = pd.to_numeric(df[name], errors='coerce')
+        elif kind == "date":
+            df[name] = to_dates(df[name])
+    return df
+
+# Sheets already loaded during this script run. Streamlit re-executes the
+# whole script on every rerun, so this dict starts empty for each render.
+RUN_SHEETS = {}
+# Values computed from several sheets during this script run
+RUN_DERIVED = {}
+
+# Local SQLite mirror of the spreadsheet, kept fresh by a background loop
+MIRROR_DB_PATH = os.environ.get("LAIKA_MIRROR_DB", local_path("laika_mirror.db"))
+MIRROR_SHEETS = [
+    "Bills", "Purchases", "Inventory", "Expenses", "CustomerKhata", "SupplierDues",
+    "LoyaltyPoints", "Services", "Offers", "PetRegister", "Balances", "HandInvestments",
+    "StockLedger", "StockSnapshots", "ItemAliases", "ItemCodes", "BillHeaders"
+]
+# Sheets that only ever grow at the bottom - the mirror just appends their new rows
+APPEND_ONLY_SHEETS = {"Bills", "Purchases", "Expenses", "CustomerKhata", "SupplierDues", "LoyaltyPoints",
+                      "StockLedger", "StockSnapshots", "ItemCodes", "BillHeaders"}
+MIRROR_SYNC_INTERVAL = 60
+MIRROR_MAX_AGE = 300
+# Append-only sheets are refreshed by fetching just their new tail; a full
+# download this often catches rows that were edited in place
+FULL_RESYNC_INTERVAL = 900
+
+# Parquet snapshot of every sheet, served straight away after a restart
+SNAPSHOT_DIR = os.environ.get("LAIKA_SNAPSHOT_DIR", local_path("laika_snapshots"))
+
+@st.cache_resource
+def get_sheet_cache():
+    """Process-wide sheet cache shared by every session and rerun"""
+    return {
+        "lock": threading.Lock(),
+        "entries": {},
+        "fetch_locks": {},
+        "mirror_lock": threading.Lock(),
+        "invalidated_at": {},
+        "full_synced_at": {},
+        "revalidating": set(),
+        "daily_sales": {"rows": 0, "last_row": None, "daily": None},
+        "derived": {},
+    }
+
+def get_fetch_lock(sheet_name):
+    """One lock per sheet so concurrent sessions share a single download"""
+    cache = get_sheet_cache()
+    with cache["lock"]:
+        return cache["fetch_locks"].setdefault(sheet_name, threading.Lock())
+
+def invalidate_sheets(*sheet_names):
+    """Drop cached sheets after a write - no names clears everything"""
+    cache = get_sheet_cache()
+    now = time.time()
+    RUN_DERIVED.clear()
+    with cache["lock"]:
+        if not sheet_names:
+            cache["entries"].clear()
+            RUN_SHEETS.clear()
+            cache["invalidated_at"]["*"] = now
+        for name in sheet_names:
+            # Keep the stale frame around - append-only sheets refresh from its tail
+            if name in cache["entries"]:
+                cache["entries"][name]["fetched_at"] = 0
+            RUN_SHEETS.pop(name, None)
+            cache["invalidated_at"][name] = now
+
+# In-line retries for a single write; the key makes a repeat harmless
+WRITE_RETRIES = 3
+WRITE_RETRY_BASE_DELAY = 0.5
+WRITE_RETRY_MAX_DELAY = 4
+
+def backoff_delay(attempt, base, cap):
+    """Exponential backoff with full jitter, so retrying clients spread out"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def post_with_retry(payload, sheet_name=None, idem_key=None):
+    """POST to the backend, retrying connection failures - raises when they persist"""
+    idem_key = idem_key or uuid.uuid4().hex
+    for attempt in range(WRITE_RETRIES):
+        try:
+            return get_backend().post(payload, sheet_name=sheet_name, idem_key=idem_key)
+        except requests.RequestException:
+            if attempt == WRITE_RETRIES - 1:
+                raise
+            time.sleep(backoff_delay(attempt, WRITE_RETRY_BASE_DELAY, WRITE_RETRY_MAX_DELAY))
+
+def post_row(sheet_name, data_list, idem_key=None):
+    """Send one row to the Apps Script - raises when the outcome is unknown"""
+    try:
+        return post_with_retry(data_list, sheet_name=sheet_name, idem_key=idem_key) == "Success"
+    finally:
+        # Even a timed-out write may have landed, so never trust the cached copy
+        invalidate_sheets(sheet_name)
 
 def save_data(sheet_name, data_list):
+    """Queue one row for the sheet - returns as soon as it is safely on disk"""
     try:
-        response = requests.post(f"{SCRIPT_URL}?sheet={sheet_name}", json=data_list, timeout=15)
-        return response.text.strip() == "Success"
+        enqueue_write("row", [sheet_name], data_list)
+        return True
     except Exception as e:
         st.error(f"Save error: {str(e)}")
         return False
 
+def post_batch(sheet_rows, idem_key=None):
+    """Send one batch_append request - raises when the outcome is unknown"""
+    writes = [{"sheet": name, "rows": rows} for name, rows in sheet_rows.items() if rows]
+    if not writes:
+        return True
+    
+    try:
+        payload = {"action": "batch_append", "writes": writes}
+        return post_with_retry(payload, idem_key=idem_key) == "Success"
+    finally:
+        invalidate_sheets(*[write["sheet"] for write in writes])
+
+def save_batch(sheet_rows):
+    """Append rows to several sheets in one request - {sheet_name: [row, ...]}"""
+    sheets = [name for name, rows in sheet_rows.items() if rows]
+    if not sheets:
+        return True
+    try:
+        if "StockLedger" in sheets:
+            ensure_stock_opening()
+        enqueue_write("batch", sheets, sheet_rows)
+        return True
+    except Exception as e:
+        st.error(f"Save error: {str(e)}")
+        return False
+
+def save_many(sheet_name, rows):
+    """Append several rows to one sheet in a single request"""
+    return save_batch({sheet_name: rows})
+
+def fetch_sheet(sheet_name, offset=0):
+    """Download and parse one sheet from the storage backend (no caching).
+    With an offset only the rows after the first `offset` data rows are returned."""
+    query = f"select * offset {int(offset)}" if offset else None
+    text = get_backend().read_csv(sheet_name, query)
+    # Read everything as text; apply_schema does the one and only type coercion
+    dtype = str if sheet_name in SHEET_SCHEMAS else None
+    if not text.strip():
+        # A sheet with no header row - still an empty frame with the schema's columns
+        return apply_schema(sheet_name, pd.DataFrame(columns=[]))
+    df = pd.read_csv(io.StringIO(text), dtype=dtype)
+    return apply_schema(sheet_name, df)
+
+def frame_checksum(df):
+    """Checksum of a sheet's values, independent of how pandas typed them"""
+    return hashlib.sha1(df.to_csv(index=False, header=False).encode()).hexdigest()
+
+def fetch_sheet_incremental(sheet_name, base_df):
+    """Bring base_df up to date - returns (df, edited).
+    Append-only sheets only download their new tail, with a periodic full
+    download whose checksum tells whether older rows were edited."""
+    full_synced_at = get_sheet_cache()["full_synced_at"]
+    started = time.time()
+    
+    if (sheet_name in APPEND_ONLY_SHEETS and base_df is not None and not base_df.empty
+            and started - full_synced_at.get(sheet_name, 0) < FULL_RESYNC_INTERVAL):
+        tail = fetch_sheet(sheet_name, offset=len(base_df))
+        if list(tail.columns) == list(base_df.columns):
+            if tail.empty:
+                return base_df, False
+            return pd.concat([base_df, tail], ignore_index=True), False
+    
+    df = fetch_sheet(sheet_name)
+    full_synced_at[sheet_name] = started
+    edited = base_df is not None and not base_df.empty and (
+        len(df) < len(base_df) or frame_checksum(df.iloc[:len(base_df)]) != frame_checksum(base_df)
+    )
+    return df, edited
+
+def quote_sql(name):
+    """Quote a sheet or column name for use as an SQLite identifier"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+def mirror_connect():
+    """Open the local mirror database"""
+    conn = sqlite3.connect(MIRROR_DB_PATH, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""CREATE TABLE IF NOT EXISTS mirror_meta (
+        sheet TEXT PRIMARY KEY, row_count INTEGER, columns TEXT, synced_at REAL)""")
+    return conn
+
+def get_mirror_meta(conn, sheet_name):
+    """Return (row_count, columns, synced_at) for a mirrored sheet, or None"""
+    row = conn.execute("SELECT row_count, columns, synced_at FROM mirror_meta WHERE sheet = ?", (sheet_name,)).fetchone()
+    if row is None:
+        return None
+    return row[0], json.loads(row[1]), row[2]
+
+def mirror_is_fresh(sheet_name, synced_at):
+    """A mirrored copy is usable if it is recent and no local write happened since"""
+    invalidated_at = get_sheet_cache()["invalidated_at"]
+    last_write = max(invalidated_at.get(sheet_name, 0), invalidated_at.get("*", 0))
+    return synced_at > last_write and time.time() - synced_at < MIRROR_MAX_AGE
+
+def write_mirror(sheet_name, df, synced_at, replace=False):
+    """Store a downloaded sheet in the mirror, inserting only the rows it lacks"""
+    table = df.copy()
+    for col in set(schema_columns(sheet_name, "date") + ['Date']) & set(table.columns):
+        table[col] = table[col].map(lambda d: d.isoformat() if pd.notna(d) else None)
+    table.insert(0, "_row", range(len(table)))
+    columns = list(df.columns)
+    
+    with get_sheet_cache()["mirror_lock"], closing(mirror_connect()) as conn:
+        meta = get_mirror_meta(conn, sheet_name)
+        if (not replace and sheet_name in APPEND_ONLY_SHEETS and meta is not None
+                and meta[1] == columns and meta[0] <= len(table)):
+            new_rows = table.iloc[meta[0]:]
+            if not new_rows.empty:
+                new_rows.to_sql(sheet_name, conn, if_exists="append", index=False)
+        else:
+            # Edited or reshaped sheets are replaced wholesale
+            table.to_sql(sheet_name, conn, if_exists="replace", index=False)
+            index_cols = [columns[0]] if columns else []
+            if 'Date' in columns:
+                index_cols.append('Date')
+            for col in index_cols:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {quote_sql(f'ix_{sheet_name}_{col}')} "
+                             f"ON {quote_sql(sheet_name)} ({quote_sql(col)})")
+        conn.execute("INSERT OR REPLACE INTO mirror_meta VALUES (?, ?, ?, ?)",
+                     (sheet_name, len(table), json.dumps(columns), synced_at))
+        conn.commit()
+
+def read_mirror(sheet_name, fresh_only=True):
+    """Read a sheet back from the mirror, or None if it has no usable copy"""
+    try:
+        with closing(mirror_connect()) as conn:
+            meta = get_mirror_meta(conn, sheet_name)
+            if meta is None or (fresh_only and not mirror_is_fresh(sheet_name, meta[2])):
+                return None
+            df = pd.read_sql_query(f"SELECT * FROM {quote_sql(sheet_name)} ORDER BY _row", conn)
+    except Exception:
+        return None
+    
+    df = df.drop(columns="_row")
+    for col in set(schema_columns(sheet_name, "date") + ['Date']) & set(df.columns):
+        df[col] = pd.to_datetime(df[col], errors='coerce', format="%Y-%m-%d").dt.date
+    return apply_schema(sheet_name, df)
+
+def mirror_sum(sheet_name, column, date_from, date_to, group_by=None):
+    """Sum one column over a date range with an indexed query on the mirror.
+    Returns a float, a Series when grouped, or None if the mirror can't answer."""
+    try:
+        with closing(mirror_connect()) as conn:
+            meta = get_mirror_meta(conn, sheet_name)
+            if meta is None or not mirror_is_fresh(sheet_name, meta[2]):
+                return None
+            columns = meta[1]
+            if not {'Date', column, group_by or column} <= set(columns):
+                return None
+            total = f"SUM({quote_sql(column)})"
+            where = f"FROM {quote_sql(sheet_name)} WHERE \"Date\" BETWEEN ? AND ?"
+            params = (date_from.isoformat(), date_to.isoformat())
+            if group_by is None:
+                row = conn.execute(f"SELECT {total} {where}", params).fetchone()
+                return float(row[0] or 0)
+            group = quote_sql(group_by)
+            rows = conn.execute(f"SELECT {group}, {total} {where} GROUP BY {group}", params).fetchall()
+        return pd.Series({key: float(value or 0) for key, value in rows}, dtype=float)
+    except Exception:
+        return None
+
+def snapshot_path(sheet_name):
+    """File holding a sheet's Parquet snapshot"""
+    return os.path.join(SNAPSHOT_DIR, f"{sheet_name}.parquet")
+
+def write_snapshot(sheet_name, df, fetched_at):
+    """Save a sheet as Parquet, stamped with the time it was downloaded"""
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b"laika_fetched_at"] = str(fetched_at).encode()
+        table = table.replace_schema_metadata(metadata)
+        
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        path = snapshot_path(sheet_name)
+        # Write aside and rename, so a reader never sees half a file
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        pass
+
+def read_snapshot(sheet_name):
+    """Return (df, fetched_at) from a sheet's snapshot, or (None, 0)"""
+    try:
+        table = pq.read_table(snapshot_path(sheet_name))
+        fetched_at = float((table.schema.metadata or {}).get(b"laika_fetched_at", b"0"))
+        return apply_schema(sheet_name, table.to_pandas()), fetched_at
+    except Exception:
+        return None, 0
+
+def sync_mirror_sheet(sheet_name):
+    """Refresh one sheet in the mirror from Google Sheets"""
+    started = time.time()
+    base_df = read_mirror(sheet_name, fresh_only=False) if sheet_name in APPEND_ONLY_SHEETS else None
+    df, edited = fetch_sheet_incremental(sheet_name, base_df)
+    write_mirror(sheet_name, df, started, replace=edited)
+    write_snapshot(sheet_name, df, started)
+
+@st.cache_resource
+def start_mirror_sync():
+    """Start the background loop that keeps the mirror in step with the sheets"""
+    def sync_loop():
+        while True:
+            synced = set()
+            for sheet_name in MIRROR_SHEETS:
+                try:
+                    sync_mirror_sheet(sheet_name)
+                    synced.add(sheet_name)
+                except Exception:
+                    pass
+            # Only snapshot stock from a complete, just-synced view of the ledger
+            if {"StockLedger", "StockSnapshots", "Inventory"} <= synced:
+                try:
+                    snapshot_stock_if_due()
+                except Exception:
+                    pass
+            time.sleep(MIRROR_SYNC_INTERVAL)
+    
+    thread = threading.Thread(target=sync_loop, name="sheet-mirror-sync", daemon=True)
+    thread.start()
+    return thread
+
+def get_cached_sheet(sheet_name):
+    """Return a fresh cached copy of a sheet, or None when it has expired.
+    An expired copy still counts while a background refresh is replacing it."""
+    cache = get_sheet_cache()
+    ttl = SHEET_CACHE_TTL.get(sheet_name, DEFAULT_CACHE_TTL)
+    with cache["lock"]:
+        entry = cache["entries"].get(sheet_name)
+        revalidating = sheet_name in cache["revalidating"]
+    if entry and time.time() - entry["fetched_at"] < ttl:
+        return entry["df"]
+    if entry and revalidating and entry["fetched_at"] > 0:
+        return entry["df"]
+    return None
+
+def refresh_shared_sheet(sheet_name):
+    """Bring one sheet's cache entry up to date - call with its fetch lock held.
+    Returns the fresh frame, or None when the sheet can't be reached."""
+    cache = get_sheet_cache()
+    started = time.time()
+    df = read_mirror(sheet_name)
+    if df is None:
+        # Grow the last copy we have (expired cache entry, else the mirror)
+        with cache["lock"]:
+            entry = cache["entries"].get(sheet_name)
+        base_df = entry["df"] if entry else None
+        if base_df is None and sheet_name in APPEND_ONLY_SHEETS:
+            base_df = read_mirror(sheet_name, fresh_only=False)
+        
+        try:
+            df, edited = fetch_sheet_incremental(sheet_name, base_df)
+        except:
+            return None
+        try:
+            write_mirror(sheet_name, df, started, replace=edited)
+        except Exception:
+            pass
+    write_snapshot(sheet_name, df, started)
+    
+    with cache["lock"]:
+        cache["entries"][sheet_name] = {"df": df, "fetched_at": time.time()}
+    return df
+
+def revalidate_in_background(sheet_name):
+    """Refresh a sheet on a worker thread while callers keep using the old copy"""
+    cache = get_sheet_cache()
+    with cache["lock"]:
+        if sheet_name in cache["revalidating"]:
+            return
+        cache["revalidating"].add(sheet_name)
+    
+    def revalidate():
+        try:
+            with get_fetch_lock(sheet_name):
+                refresh_shared_sheet(sheet_name)
+        finally:
+            with cache["lock"]:
+                cache["revalidating"].discard(sheet_name)
+    
+    threading.Thread(target=revalidate, name=f"revalidate-{sheet_name}", daemon=True).start()
+
+def load_snapshot_entry(sheet_name):
+    """On a cold cache, adopt the on-disk snapshot and revalidate it in the background.
+    Returns None if there is no snapshot or a local write has made it stale."""
+    df, fetched_at = read_snapshot(sheet_name)
+    if df is None:
+        return None
+    
+    cache = get_sheet_cache()
+    with cache["lock"]:
+        last_write = max(cache["invalidated_at"].get(sheet_name, 0), cache["invalidated_at"].get("*", 0))
+        if fetched_at <= last_write:
+            return None
+        cache["entries"].setdefault(sheet_name, {"df": df, "fetched_at": fetched_at})
+    
+    if time.time() - fetched_at >= SHEET_CACHE_TTL.get(sheet_name, DEFAULT_CACHE_TTL):
+        revalidate_in_background(sheet_name)
+    return df
+
+def load_shared_sheet(sheet_name):
+    """Load a sheet through the shared cache with single-flight downloads"""
+    df = get_cached_sheet(sheet_name)
+    if df is not None:
+        return df.copy()
+    
+    # Only one session downloads a given sheet; the rest wait and reuse it
+    with get_fetch_lock(sheet_name):
+        df = get_cached_sheet(sheet_name)
+        if df is not None:
+            return df.copy()
+        
+        with get_sheet_cache()["lock"]:
+            cold = sheet_name not in get_sheet_cache()["entries"]
+        if cold:
+            df = load_snapshot_entry(sheet_name)
+            if df is not None:
+                return df.copy()
+        
+        df = refresh_shared_sheet(sheet_name)
+        if df is None:
+            # Network blip: serve the last mirrored copy, but don't cache it
+            df = read_mirror(sheet_name, fresh_only=False)
+            return df if df is not None else pd.DataFrame()
+        return df.copy()
+
 def load_data(sheet_name):
+    """Load a sheet once per script run - every caller gets the same frame"""
+    if sheet_name in RUN_SHEETS:
+        return RUN_SHEETS[sheet_name]
+    
+    df = load_shared_sheet(sheet_name)
+    if not df.empty:
+        RUN_SHEETS[sheet_name] = df
+    return df
+
+def get_sheet_index(sheet_name, build):
+    """Lookup structure derived from a sheet by build(df), made once per downloaded
+    version of the sheet and shared by every session until it is replaced"""
+    df = load_data(sheet_name)
+    cache = get_sheet_cache()
+    with cache["lock"]:
+        entry = cache["entries"].get(sheet_name)
+    if entry is None:
+        # Served from a fallback copy that isn't cached - build for this run only
+        return build(df)
+    indexes = entry.setdefault("indexes", {})
+    if build.__name__ not in indexes:
+        indexes[build.__name__] = build(entry["df"])
+    return indexes[build.__name__]
+
+def get_sheets_index(sheet_names, build):
+    """Like get_sheet_index, for a structure built from several sheets by
+    build(*frames) - rebuilt when any of them is replaced"""
+    frames = load_many(sheet_names)
+    cache = get_sheet_cache()
+    with cache["lock"]:
+        entries = [cache["entries"].get(name) for name in sheet_names]
+        built = cache["derived"].get(build.__name__)
+    if any(entry is None for entry in entries):
+        return build(*[frames[name] for name in sheet_names])
+    
+    versions = [entry["df"] for entry in entries]
+    if built and all(old is new for old, new in zip(built[0], versions)):
+        return built[1]
+    value = build(*versions)
+    with cache["lock"]:
+        cache["derived"][build.__name__] = (versions, value)
+    return value
+
+# --- INVENTORY INDEX ---
+def normalize_item(item_name):
+    """Item name as used for lookups - trimmed and upper-case"""
+    return str(item_name).strip().upper()
+
+def build_inventory_index(inv_df):
+    """{normalized item: latest record} - later rows of the sheet win"""
+    index = {}
+    if inv_df.empty:
+        return index
+    rows = inv_df.dropna(subset=['Item'])
+    for item, qty, unit, rate, row_date in zip(rows['Item'], rows['Qty'], rows['Unit'], rows['Rate'], rows['Date']):
+        index[normalize_item(item)] = {"item": item, "qty": qty, "unit": unit, "rate": rate, "date": row_date}
+    return index
+
+def get_inventory_index():
+    """Latest qty, unit, rate and date of every item, by normalized name"""
+    return get_sheet_index("Inventory", build_inventory_index)
+
+def get_inventory_item(item_name):
+    """Latest inventory record of one item, or None if it isn't stocked"""
+    return get_inventory_index().get(normalize_item(item_name))
+
+# --- ITEM CODES ---
+# Barcodes / SKUs live in the ItemCodes sheet (Code, Item, SellingPrice).
+# A code is re-pointed by appending a new row for it - later rows win.
+def normalize_code(code):
+    """Code as used for lookups - trimmed and upper-case"""
+    return str(code).strip().upper()
+
+def build_item_code_index(code_df):
+    """{normalized code: {"item", "price"}} - later rows of the sheet win"""
+    index = {}
+    if code_df.empty:
+        return index
+    rows = code_df.dropna(subset=['Code', 'Item'])
+    for code, item, price in zip(rows['Code'], rows['Item'], rows['SellingPrice']):
+        index[normalize_code(code)] = {"item": item, "price": float(price) if pd.notna(price) else 0.0}
+    return index
+
+def get_item_by_code(code):
+    """Item record for a scanned code (name, unit, last rate, selling price), or None"""
+    found = get_sheet_index("ItemCodes", build_item_code_index).get(normalize_code(code))
+    if not found:
+        return None
+    record = get_inventory_item(found["item"])
+    if record is None:
+        return None
+    return {**record, "price": found["price"]}
+
+def add_scanned_item():
+    """Scan field callback - puts the scanned item in the bill cart and clears the field.
+    Accepts "CODE" or "QTY*CODE"; repeat scans of an item add to its cart line."""
+    scanned = st.session_state.bill_scan.strip()
+    st.session_state.bill_scan = ""
+    if not scanned:
+        return
+    qty, _, code = scanned.rpartition("*")
     try:
-        url = f"{SHEET_LINK}{sheet_name}&cache={time.time()}"
-        df = pd.read_csv(url)
-        df.columns = df.columns.str.strip()
-        date_col = next((c for c in df.columns if 'date' in c.lower()), None)
-        if date_col:
-            df[date_col] = pd.to_datetime(df[date_col], errors='coerce', dayfirst=True).dt.date
-            df = df.rename(columns={date_col: 'Date'})
-        return df
-    except: 
-        return pd.DataFrame()
+        qty = float(qty) if qty else 1.0
+    except ValueError:
+        qty = 0.0
+    if not math.isfinite(qty) or qty <= 0:
+        st.session_state.bill_scan_msg = ("error", f"❌ Bad quantity in '{scanned}'")
+        return
+    
+    record = get_item_by_code(code)
+    if record is None:
+        st.session_state.bill_scan_msg = ("error", f"❌ Unknown code: {code}")
+        return
+    
+    purchase_rate = get_item_purchase_rate(record["item"])
+    rate = record["price"] or round(purchase_rate * 1.2, 2)
+    for line in st.session_state.bill_cart:
+        if line['Item'] == record["item"] and line['Rate'] == rate:
+            line['Qty'] += qty
+            line['Amount'] = line['Qty'] * rate
+            break
+    else:
+        st.session_state.bill_cart.append({
+            'Item': record["item"],
+            'Qty': qty,
+            'Rate': rate,
+            'Amount': qty * rate,
+            'Purchase_Rate': purchase_rate
+        })
+    st.session_state.bill_scan_msg = ("success", f"✅ {record['item']} x{qty:g} @ ₹{rate:.2f}")
+
+# --- ITEM SEARCH ---
+# Trigram index over item names, their aliases (ItemAliases sheet) and the
+# suppliers they were bought from. Overlapping trigrams tolerate typos; whole
+# and word prefixes rank first. Pickers only ever hold the top matches.
+SEARCH_RESULTS = 15
+SEARCH_MIN_SCORE = 0.25
+# Weight of a match on an item's own name, an alias, or a supplier name
+SEARCH_WEIGHTS = {"item": 1.0, "alias": 0.9, "supplier": 0.6}
+
+def search_grams(text):
+    """Trigrams of a normalized, padded string"""
+    text = f"  {normalize_item(text)} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def build_item_search_index(inv_df, purch_df, alias_df):
+    """Trigram postings over every name an item can be found by"""
+    items = {}
+    if not inv_df.empty:
+        for item in inv_df['Item'].dropna():
+            items[normalize_item(item)] = item
+    
+    names = {(key, key, "item") for key in items}
+    if not alias_df.empty:
+        for alias, item in zip(alias_df['Alias'], alias_df['Item']):
+            if pd.notna(alias) and normalize_item(item) in items:
+                names.add((normalize_item(alias), normalize_item(item), "alias"))
+    if not purch_df.empty:
+        for supplier, item in zip(purch_df['Supplier'], purch_df['Item']):
+            if pd.notna(supplier) and normalize_item(item) in items:
+                names.add((normalize_item(supplier), normalize_item(item), "supplier"))
+    
+    entries = []
+    postings = {}
+    for text, key, kind in sorted(names):
+        grams = search_grams(text)
+        for gram in grams:
+            postings.setdefault(gram, []).append(len(entries))
+        entries.append((text, key, SEARCH_WEIGHTS[kind], len(grams)))
+    return {"items": items, "entries": entries, "postings": postings,
+            "sorted": sorted(items.values(), key=str)}
+
+def get_item_search_index():
+    """Item search index for the current Inventory, Purchases and ItemAliases"""
+    return get_sheets_index(["Inventory", "Purchases", "ItemAliases"], build_item_search_index)
+
+def search_items(query, k=SEARCH_RESULTS, index=None):
+    """Top-k item names for a query - the first k names when it is empty"""
+    index = index or get_item_search_index()
+    query = normalize_item(query or "")
+    if not query:
+        return index["sorted"][:k]
+    
+    grams = search_grams(query)
+    shared = Counter()
+    for gram in grams:
+        shared.update(index["postings"].get(gram, ()))
+    
+    best = {}
+    for n, count in shared.items():
+        text, key, weight, gram_count = index["entries"][n]
+        score = 2 * count / (len(grams) + gram_count)
+        if text.startswith(query):
+            score += 1
+        elif f" {query}" in f" {text}":
+            score += 0.5
+        score *= weight
+        if score >= SEARCH_MIN_SCORE and score > best.get(key, 0):
+            best[key] = score
+    ranked = sorted(best, key=lambda key: (-best[key], key))[:k]
+    return [index["items"][key] for key in ranked]
+
+# --- STOCK LEDGER ---
+# Stock is a ledger of movements (purchase, sale, adjustment, return) plus
+# periodic snapshots of every item's quantity. Current stock is the latest
+# snapshot plus the ledger rows written after it. The opening balances are
+# snapshotted before the first ledger row is written; once the ledger runs,
+# new Inventory rows are purchase lots and never opening balances.
+STOCK_SNAPSHOT_EVERY = 500
+
+def build_stock_baseline(snap_df):
+    """(ledger rows covered, {item: qty}) of the latest stock snapshot, or None"""
+    if snap_df.empty or snap_df['LedgerRows'].isna().all():
+        return None
+    covered = snap_df['LedgerRows'].max()
+    latest = snap_df[snap_df['LedgerRows'] == covered]
+    return int(covered), dict(zip(latest['Item'].map(normalize_item), latest['Qty'].fillna(0)))
+
+def opening_stock(inv_df, ledger_df):
+    """{normalized item: qty} before the ledger - each item's last Inventory row,
+    leaving out the lot rows dated from the ledger's first movement on"""
+    if not ledger_df.empty and not inv_df.empty:
+        started = ledger_df['Date'].dropna().min()
+        inv_df = inv_df[inv_df['Date'].map(lambda d: pd.notna(d) and pd.notna(started) and d < started)]
+    return {key: 0 if pd.isna(record["qty"]) else record["qty"]
+            for key, record in build_inventory_index(inv_df).items()}
+
+def compute_stock(ledger_df, baseline, inv_df):
+    """{normalized item: qty} - a baseline snapshot (else the opening stock)
+    plus the ledger rows after it"""
+    if baseline is None:
+        covered = 0
+        stock = opening_stock(inv_df, ledger_df)
+    else:
+        covered, stock = baseline[0], dict(baseline[1])
+    
+    recent = ledger_df.iloc[covered:]
+    if not recent.empty:
+        changes = recent.groupby(recent['Item'].map(normalize_item))['Change'].sum()
+        for item, change in changes.items():
+            stock[item] = stock.get(item, 0) + change
+    return stock
+
+def get_current_stock():
+    """Current quantity of every item, by normalized name"""
+    if "stock" not in RUN_DERIVED:
+        frames = load_many(["StockLedger", "StockSnapshots", "Inventory"])
+        baseline = get_sheet_index("StockSnapshots", build_stock_baseline)
+        RUN_DERIVED["stock"] = compute_stock(frames["StockLedger"], baseline, frames["Inventory"])
+    return RUN_DERIVED["stock"]
+
+def current_stock_table():
+    """One row per item: Item, Qty, Unit, Rate (unit cost) and Value under
+    STOCK_VALUATION, plus FIFO Value and Avg Value for comparison"""
+    inventory_index = get_inventory_index()
+    stock = get_current_stock()
+    keys = list(stock.keys())
+    qty = np.array([stock[key] for key in keys], dtype=float)
+    fifo_value = fifo_stock_value(keys, qty)
+    avg_value = np.clip(qty, 0, None) * average_cost(keys)
+    
+    table = pd.DataFrame({
+        "Item": [inventory_index.get(key, {}).get("item", key) for key in keys],
+        "Qty": qty,
+        "Unit": [inventory_index.get(key, {}).get("unit", "") for key in keys],
+        "FIFO Value": fifo_value,
+        "Avg Value": avg_value,
+    })
+    table["Value"] = table["FIFO Value"] if STOCK_VALUATION == "fifo" else table["Avg Value"]
+    table["Rate"] = (table["Value"] / table["Qty"]).where(table["Qty"] > 0, 0)
+    return table[["Item", "Qty", "Unit", "Rate", "Value", "FIFO Value", "Avg Value"]]
+
+def snapshot_stock_if_due():
+    """Queue a snapshot of every item's quantity once enough movements have built up.
+    Runs on the mirror loop, from freshly synced mirror copies."""
+    ledger_df = read_mirror("StockLedger", fresh_only=False)
+    snap_df = read_mirror("StockSnapshots", fresh_only=False)
+    inv_df = read_mirror("Inventory", fresh_only=False)
+    if ledger_df is None or snap_df is None or inv_df is None:
+        return False
+    
+    baseline = build_stock_baseline(snap_df)
+    # The first snapshot freezes the opening balances; later ones just shorten the replay
+    if baseline is not None and len(ledger_df) - baseline[0] < STOCK_SNAPSHOT_EVERY:
+        return False
+    if any("StockSnapshots" in entry["sheets"] for entry in get_outbox_entries(statuses=("pending",))):
+        return False
+    
+    stock = compute_stock(ledger_df, baseline, inv_df)
+    if not stock:
+        return False
+    today = datetime.now().strftime("%d/%m/%Y")
+    rows = [[today, item, qty, len(ledger_df)] for item, qty in stock.items()]
+    enqueue_write("batch", ["StockSnapshots"], {"StockSnapshots": rows}, idem_key=f"stock-snapshot-{len(ledger_df)}")
+    return True
+
+def ensure_stock_opening():
+    """Snapshot the opening stock before the first ledger row is written, so the
+    Inventory lot rows written alongside ledger rows never count as opening stock"""
+    if not load_data("StockLedger").empty or not load_data("StockSnapshots").empty:
+        return
+    # Cached copies may be behind - only a fresh read can say the ledger hasn't started
+    ledger_df = fetch_sheet("StockLedger")
+    if not ledger_df.empty or not fetch_sheet("StockSnapshots").empty:
+        return
+    stock = compute_stock(ledger_df, None, fetch_sheet("Inventory"))
+    today = datetime.now().strftime("%d/%m/%Y")
+    rows = [[today, item, qty, 0] for item, qty in stock.items()]
+    if rows and not post_batch({"StockSnapshots": rows}, idem_key="stock-opening"):
+        raise RuntimeError("Opening stock snapshot was not saved")
+
+# --- COST ENGINE ---
+# Purchase lots are the Purchases rows (qty bought, amount paid), ordered by item
+# then purchase date and laid end to end in cumulative-qty and cumulative-cost
+# arrays. Because the running totals only grow, one np.searchsorted call over
+# them answers "what did the first x units of each item cost" for every item.
+STOCK_VALUATION = os.environ.get("LAIKA_VALUATION", "fifo")
+
+def build_cost_lots(purch_df, inv_df):
+    """Purchase lots as cumulative arrays plus each item's slice of them.
+    Inventory rows can't be lots: sales used to rewrite their Qty in place. An item
+    never bought through Purchases gets one opening lot from its first Inventory row."""
+    lots = pd.DataFrame({"key": [], "qty": [], "rate": [], "day": []})
+    if not purch_df.empty:
+        rows = purch_df.dropna(subset=['Item'])
+        # Quantity is saved as "<qty> <unit>"
+        qty = pd.to_numeric(rows['Quantity'].astype(str).str.extract(r'^\s*([\d.]+)')[0], errors='coerce').fillna(0)
+        lots = pd.DataFrame({
+            "key": rows['Item'].map(normalize_item),
+            "qty": qty,
+            "rate": (rows['Amount'].fillna(0) / qty.where(qty > 0, 1)),
+            "day": rows['Date'].map(lambda d: d.toordinal() if pd.notna(d) else 0),
+        })
+    if not inv_df.empty:
+        rows = inv_df.dropna(subset=['Item']).assign(key=lambda df: df['Item'].map(normalize_item))
+        opening = rows[~rows['key'].isin(set(lots['key']))].drop_duplicates('key')
+        lots = pd.concat([lots, pd.DataFrame({
+            "key": opening['key'],
+            "qty": opening['Qty'].fillna(0),
+            "rate": opening['Rate'].fillna(0),
+            "day": opening['Date'].map(lambda d: d.toordinal() if pd.notna(d) else 0),
+        })], ignore_index=True)
+    lots = lots[lots['qty'] > 0]
+    lots = lots.sort_values(['key', 'day'], kind='mergesort').reset_index(drop=True)
+    
+    qty = lots['qty'].to_numpy(dtype=float)
+    rate = lots['rate'].to_numpy(dtype=float)
+    cum_qty = np.cumsum(qty)
+    cum_cost = np.cumsum(qty * rate)
+    groups = lots.groupby('key', sort=False).indices
+    first = {key: idx[0] for key, idx in groups.items()}
+    last = {key: idx[-1] for key, idx in groups.items()}
+    # Item codes and days folded into one sorted key, for date lookups across all items
+    codes = {key: n for n, key in enumerate(groups)}
+    return {
+        "qty": qty, "rate": rate, "cum_qty": cum_qty, "cum_cost": cum_cost,
+        "first": first, "last": last, "codes": codes,
+        "stamp": lots['key'].map(codes).to_numpy(dtype=np.int64) * 10**7 + lots['day'].to_numpy(dtype=np.int64),
+    }
+
+def get_cost_lots():
+    """Cost lots of the current Purchases and Inventory versions"""
+    return get_sheets_index(["Purchases", "Inventory"], build_cost_lots)
+
+def lot_slices(lots, keys):
+    """(first, last, qty before, cost before, has lots) arrays for a list of item keys"""
+    has = np.array([key in lots["first"] for key in keys], dtype=bool)
+    first = np.array([lots["first"].get(key, 0) for key in keys], dtype=np.int64)
+    last = np.array([lots["last"].get(key, 0) for key in keys], dtype=np.int64)
+    if len(lots["qty"]):
+        base_qty = np.where(has, lots["cum_qty"][first] - lots["qty"][first], 0)
+        base_cost = np.where(has, lots["cum_cost"][first] - lots["qty"][first] * lots["rate"][first], 0)
+    else:
+        base_qty = base_cost = np.zeros(len(keys))
+    return first, last, base_qty, base_cost, has
+
+def fifo_cost(keys, units):
+    """Cost of each item's first `units` units in purchase order (vectorized).
+    Units beyond everything ever bought are costed at the latest rate."""
+    lots = get_cost_lots()
+    units = np.clip(np.asarray(units, dtype=float), 0, None)
+    first, last, base_qty, base_cost, has = lot_slices(lots, keys)
+    if not has.any():
+        return np.zeros(len(keys))
+    
+    bought = np.where(has, lots["cum_qty"][last] - base_qty, 0)
+    covered = np.minimum(units, bought)
+    target = base_qty + covered
+    k = np.clip(np.searchsorted(lots["cum_qty"], target, side='left'), first, last)
+    cost = lots["cum_cost"][k] - (lots["cum_qty"][k] - target) * lots["rate"][k] - base_cost
+    cost += (units - covered) * lots["rate"][last]
+    return np.where(has, cost, 0)
+
+def fifo_stock_value(keys, stock_qty):
+    """FIFO value of stock on hand - the newest units bought are the ones left"""
+    lots = get_cost_lots()
+    stock_qty = np.clip(np.asarray(stock_qty, dtype=float), 0, None)
+    first, last, base_qty, base_cost, has = lot_slices(lots, keys)
+    if not has.any():
+        return np.zeros(len(keys))
+    bought = np.where(has, lots["cum_qty"][last] - base_qty, 0)
+    older = np.clip(bought - stock_qty, 0, None)
+    return fifo_cost(keys, np.maximum(bought, stock_qty)) - fifo_cost(keys, older)
+
+def average_cost(keys, on_dates=None):
+    """Weighted-average unit cost of each item over the lots bought up to a date
+    (all lots when no dates are given) - the moving average as of that day"""
+    lots = get_cost_lots()
+    first, last, base_qty, base_cost, has = lot_slices(lots, keys)
+    if not has.any():
+        return np.zeros(len(keys))
+    
+    if on_dates is None:
+        k = last
+    else:
+        codes = np.array([lots["codes"].get(key, 0) for key in keys], dtype=np.int64)
+        days = np.array([d.toordinal() if pd.notna(d) else 0 for d in on_dates], dtype=np.int64)
+        # Last lot of the item on or before the day; a sale before the first lot uses the first lot
+        k = np.clip(np.searchsorted(lots["stamp"], codes * 10**7 + days, side='right') - 1, first, last)
+    units = lots["cum_qty"][k] - base_qty
+    avg = (lots["cum_cost"][k] - base_cost) / np.where(units > 0, units, 1)
+    return np.where(has, avg, 0)
+
+def sales_cogs(bills_df, method=None):
+    """Cost of goods sold for every Bills row, by FIFO or moving weighted average"""
+    method = method or STOCK_VALUATION
+    if bills_df.empty:
+        return pd.Series(dtype=float)
+    keys = bills_df['Item'].map(normalize_item).tolist()
+    qty = bills_df['Qty'].fillna(0).clip(lower=0)
+    if method == "fifo":
+        # Units of the item sold up to and including each sale, in sheet order
+        sold_after = qty.groupby(bills_df['Item'].map(normalize_item)).cumsum()
+        cost = fifo_cost(keys, sold_after) - fifo_cost(keys, sold_after - qty)
+    else:
+        cost = qty.to_numpy() * average_cost(keys, bills_df['Date'].tolist())
+    return pd.Series(cost, index=bills_df.index)
+
+def period_cogs(date_from, date_to, method=None):
+    """Cost of the items sold between two dates (inclusive)"""
+    bills_df = load_data("Bills")
+    if bills_df.empty:
+        return 0.0
+    cogs = sales_cogs(bills_df, method)
+    in_period = (bills_df['Date'] >= date_from) & (bills_df['Date'] <= date_to)
+    return float(cogs[in_period].sum())
+
+# --- REORDER ENGINE ---
+# Sales velocity from Bills over two rolling windows, blended so a recent rush
+# counts more than last month. An item needs reordering once its stock won't
+# last the supplier's lead time plus a safety margin.
+VELOCITY_SHORT_DAYS = 7
+VELOCITY_LONG_DAYS = 30
+VELOCITY_SHORT_WEIGHT = 0.6
+DEFAULT_LEAD_DAYS = int(os.environ.get("LAIKA_LEAD_DAYS", "3"))
+# Days from order to delivery by supplier, as JSON in LAIKA_SUPPLIER_LEAD_DAYS,
+# e.g. {"Sharma Traders": 2, "Pet Hub": 5} - names match case-insensitively
+SUPPLIER_LEAD_DAYS = {normalize_item(name): int(days) for name, days
+                      in json.loads(os.environ.get("LAIKA_SUPPLIER_LEAD_DAYS", "{}")).items()}
+SAFETY_DAYS = 2
+# An order should last this long after it arrives
+REORDER_COVER_DAYS = 14
+OVERSTOCK_DAYS = 90
+
+def get_daily_sales():
+    """Qty sold per (item, date), folded in incrementally as new bills land"""
+    bills_df = load_data("Bills")
+    if bills_df.empty:
+        # No bills yet (or Bills couldn't be loaded) - leave the running totals alone
+        return pd.Series(dtype=float, index=pd.MultiIndex.from_arrays([[], []], names=['Item', 'Date']))
+    cache = get_sheet_cache()
+    with cache["lock"]:
+        state = cache["daily_sales"]
+    
+    seen = state["rows"]
+    # The last row we counted must be unchanged for the running totals to still hold
+    last_row = bills_df.iloc[seen - 1:seen].to_csv(index=False) if 0 < seen <= len(bills_df) else None
+    if seen > len(bills_df) or last_row != state["last_row"]:
+        # Rows were removed or edited - start again from the top
+        seen, daily = 0, None
+    else:
+        daily = state["daily"]
+    
+    new_rows = bills_df.iloc[seen:]
+    if not new_rows.empty:
+        added = new_rows.groupby([new_rows['Item'].map(normalize_item), 'Date'])['Qty'].sum()
+        daily = added if daily is None else daily.add(added, fill_value=0)
+        state = {"rows": len(bills_df), "last_row": bills_df.iloc[-1:].to_csv(index=False), "daily": daily}
+        with cache["lock"]:
+            cache["daily_sales"] = state
+    return daily
+
+def build_item_suppliers(purch_df):
+    """{normalized item: supplier of its latest purchase}"""
+    if purch_df.empty:
+        return {}
+    rows = purch_df.dropna(subset=['Item'])
+    return dict(zip(rows['Item'].map(normalize_item), rows['Supplier']))
+
+def reorder_table(stock_table, today):
+    """Stock table with daily velocity, days of cover, reorder point, suggested
+    order qty and a status of 'out', 'reorder', 'overstock' or 'ok' per item"""
+    table = stock_table.copy()
+    daily = get_daily_sales()
+    keys = table['Item'].map(normalize_item)
+    
+    if daily is not None and not daily.empty:
+        sale_dates = pd.Series(daily.index.get_level_values(1))
+        in_short = (sale_dates > today - timedelta(days=VELOCITY_SHORT_DAYS)).values
+        in_long = (sale_dates > today - timedelta(days=VELOCITY_LONG_DAYS)).values
+        sold_short = keys.map(daily[in_short].groupby(level=0).sum()).fillna(0)
+        sold_long = keys.map(daily[in_long].groupby(level=0).sum()).fillna(0)
+    else:
+        sold_short = sold_long = pd.Series(0.0, index=table.index)
+    
+    table['Velocity'] = (VELOCITY_SHORT_WEIGHT * sold_short / VELOCITY_SHORT_DAYS
+                         + (1 - VELOCITY_SHORT_WEIGHT) * sold_long / VELOCITY_LONG_DAYS)
+    suppliers = get_sheet_index("Purchases", build_item_suppliers)
+    table['Lead Days'] = keys.map(lambda key: SUPPLIER_LEAD_DAYS.get(normalize_item(suppliers.get(key, "")), DEFAULT_LEAD_DAYS))
+    table['Days Cover'] = (table['Qty'] / table['Velocity']).where(table['Velocity'] > 0, np.inf)
+    table['Reorder Point'] = table['Velocity'] * (table['Lead Days'] + SAFETY_DAYS)
+    target = table['Velocity'] * (table['Lead Days'] + SAFETY_DAYS + REORDER_COVER_DAYS)
+    table['Order Qty'] = np.ceil((target - table['Qty']).clip(lower=0))
+    table['Status'] = np.select(
+        [table['Qty'] <= 0, table['Qty'] <= table['Reorder Point'], table['Days Cover'] > OVERSTOCK_DAYS],
+        ['out', 'reorder', 'overstock'], default='ok'
+    )
+    return table
+
+# --- QUERY PUSHDOWN ---
+def column_letter(col_idx):
+    """Spreadsheet column letter for a 0-based column position"""
+    letters = ""
+    col_idx += 1
+    while col_idx:
+        col_idx, rem = divmod(col_idx - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
 
-def update_stock_in_sheet(item_name, qty_change, operation='subtract'):
-    """Update stock in Google Sheets - subtract for sales, add for purchase"""
+def build_sum_query(sheet_name, column, date_from, date_to, group_by=None):
+    """gviz query summing one column over a date range, optionally grouped"""
+    date_col = column_letter(schema_position(sheet_name, 'Date'))
+    total = f"sum({column_letter(schema_position(sheet_name, column))})"
+    where = (f"where {date_col} >= date '{date_from:%Y-%m-%d}' "
+             f"and {date_col} <= date '{date_to:%Y-%m-%d}'")
+    if group_by is None:
+        return f"select {total} {where} label {total} 'total'"
+    group = column_letter(schema_position(sheet_name, group_by))
+    return f"select {group}, {total} {where} group by {group} label {total} 'total'"
+
+def gviz_sum(sheet_name, column, date_from, date_to, group_by=None):
+    """Let Google compute a date-range sum so only the result is transferred.
+    Returns None when the query can't be run (e.g. the column is stored as text)."""
+    if 'Date' not in dict(SHEET_SCHEMAS.get(sheet_name, [])):
+        return None
     try:
-        item_name = str(item_name).strip().upper()
-        qty_change = float(qty_change)
-        
-        # Get current stock
-        inv_df = load_data("Inventory")
-        if inv_df.empty:
-            return False
-        
-        item_rows = inv_df[inv_df.iloc[:, 0].str.strip().str.upper() == item_name]
-        if item_rows.empty:
-            return False
-        
-        latest_row = item_rows.iloc[-1]
-        current_qty = float(pd.to_numeric(latest_row.iloc[1], errors='coerce'))
-        
-        if operation == 'subtract':
-            new_qty = current_qty - qty_change
+        query = build_sum_query(sheet_name, column, date_from, date_to, group_by)
+        result = pd.read_csv(io.StringIO(get_backend().read_csv(sheet_name, query)))
+        totals = pd.to_numeric(result.iloc[:, -1], errors='raise') if not result.empty else pd.Series(dtype=float)
+    except Exception:
+        return None
+    
+    if group_by is None:
+        return float(totals.sum())
+    return pd.Series(totals.values, index=result.iloc[:, 0].values, dtype=float)
+
+def pandas_sum(sheet_name, column, date_from, date_to, group_by=None):
+    """Date-range sum computed locally on the full sheet"""
+    df = load_data(sheet_name)
+    if df.empty:
+        return 0 if group_by is None else pd.Series(dtype=float)
+    period = df[(df['Date'] >= date_from) & (df['Date'] <= date_to)]
+    if group_by is None:
+        return period[column].sum()
+    return period.groupby(group_by)[column].sum()
+
+def sheet_total(sheet_name, column, date_from, date_to):
+    """Total of one column between two dates (inclusive).
+    Tries the local mirror, then a gviz aggregate query, then pandas."""
+    for query in (mirror_sum, gviz_sum, pandas_sum):
+        total = query(sheet_name, column, date_from, date_to)
+        if total is not None:
+            return total
+
+def sheet_totals_by(sheet_name, column, group_by, date_from, date_to):
+    """Totals of one column per value of another, between two dates (inclusive)"""
+    for query in (mirror_sum, gviz_sum, pandas_sum):
+        totals = query(sheet_name, column, date_from, date_to, group_by)
+        if totals is not None:
+            return totals
+
+def load_many(sheet_names):
+    """Load several sheets in parallel - returns {sheet_name: DataFrame}"""
+    frames = {name: RUN_SHEETS[name] for name in sheet_names if name in RUN_SHEETS}
+    missing = [name for name in sheet_names if name not in frames]
+    
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(LOAD_MANY_WORKERS, len(missing))) as pool:
+            for name, df in zip(missing, pool.map(load_shared_sheet, missing)):
+                frames[name] = df
+                if not df.empty:
+                    RUN_SHEETS[name] = df
+    return frames
+
+def stock_deltas(stock_changes, sign):
+    """Sum [[item, qty], ...] into {normalized item: sign * qty}"""
+    deltas = {}
+    for item_name, qty in stock_changes:
+        key = normalize_item(item_name)
+        deltas[key] = deltas.get(key, 0) + sign * float(qty)
+    return {key: delta for key, delta in deltas.items() if delta}
+
+def apply_stock_deltas(deltas, kind, ref="", idem_key=None):
+    """Record stock movements of one kind in one request - {item: +qty or -qty}.
+    The backend checks and appends them to StockLedger together, or not at all.
+    Returns False when rejected (e.g. insufficient stock); raises when the outcome is unknown."""
+    if not deltas:
+        return True
+    ensure_stock_opening()
+    payload = {
+        "action": "apply_stock_deltas",
+        "deltas": deltas,
+        "kind": kind,
+        "ref": ref,
+        "date": datetime.now().strftime("%d/%m/%Y"),
+        "user": st.session_state.get("username", "")
+    }
+    try:
+        response_text = post_with_retry(payload, idem_key=idem_key)
+    finally:
+        invalidate_sheets("StockLedger")
+    
+    if response_text == "SUCCESS":
+        return True
+    st.error(f"❌ Stock update rejected: {response_text}")
+    return False
+
+# --- WRITE-BEHIND QUEUE ---
+# Saves go to a durable outbox on disk and a background worker sends them to
+# the Apps Script, oldest first. A write that fails holds back later writes to
+# the same sheets, so rows always land in the order they were entered.
+# Every entry carries an idempotency key sent with each delivery attempt, so a
+# write that landed but timed out is not appended twice when it is retried.
+OUTBOX_POLL_INTERVAL = 2
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE = 5
+OUTBOX_BACKOFF_CAP = 300
+OUTBOX_KEEP_SYNCED = 24 * 3600
+
+def outbox_connect():
+    """Open the write-behind outbox (kept in the mirror database)"""
+    conn = mirror_connect()
+    conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL, kind TEXT, sheets TEXT,
+        payload TEXT, status TEXT, attempts INTEGER, next_attempt_at REAL, error TEXT, synced_at REAL,
+        idem_key TEXT)""")
+    if "idem_key" not in [col[1] for col in conn.execute("PRAGMA table_info(outbox)")]:
+        # Outbox from before keys existed - give queued writes one now
+        conn.execute("ALTER TABLE outbox ADD COLUMN idem_key TEXT")
+        conn.execute("UPDATE outbox SET idem_key = 'outbox-' || id")
+        conn.commit()
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_outbox_idem_key ON outbox (idem_key)")
+    return conn
+
+@st.cache_resource
+def get_outbox_signal():
+    """Event used to wake the worker as soon as something is queued"""
+    return threading.Event()
+
+def enqueue_write(kind, sheets, payload, idem_key=None):
+    """Durably queue a write - kind is 'row' (one sheet) or 'batch' ({sheet: rows}).
+    Queuing the same idem_key twice keeps only the first write."""
+    idem_key = idem_key or uuid.uuid4().hex
+    with closing(outbox_connect()) as conn:
+        conn.execute("INSERT OR IGNORE INTO outbox (created_at, kind, sheets, payload, status, attempts, "
+                     "next_attempt_at, idem_key) VALUES (?, ?, ?, ?, 'pending', 0, 0, ?)",
+                     (time.time(), kind, json.dumps(sheets), json.dumps(payload), idem_key))
+        conn.commit()
+    get_outbox_signal().set()
+    return idem_key
+
+def get_outbox_entries(statuses=("pending", "failed", "synced"), limit=None):
+    """Queued writes, oldest first - or the newest `limit` of them, newest first"""
+    query = (f"SELECT id, created_at, kind, sheets, payload, status, attempts, next_attempt_at, error, synced_at, "
+             f"idem_key FROM outbox WHERE status IN ({','.join('?' * len(statuses))})")
+    query += f" ORDER BY id DESC LIMIT {int(limit)}" if limit else " ORDER BY id"
+    with closing(outbox_connect()) as conn:
+        rows = conn.execute(query, statuses).fetchall()
+    keys = ["id", "created_at", "kind", "sheets", "payload", "status", "attempts", "next_attempt_at", "error",
+            "synced_at", "idem_key"]
+    entries = [dict(zip(keys, row)) for row in rows]
+    for entry in entries:
+        entry["sheets"] = json.loads(entry["sheets"])
+        entry["payload"] = json.loads(entry["payload"])
+    return entries
+
+def get_outbox_counts():
+    """Number of queued writes per status"""
+    with closing(outbox_connect()) as conn:
+        return dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+def update_outbox_entry(entry_id, **fields):
+    """Persist the delivery state of a queued write"""
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with closing(outbox_connect()) as conn:
+        conn.execute(f"UPDATE outbox SET {assignments} WHERE id = ?", (*fields.values(), entry_id))
+        conn.commit()
+
+def retry_outbox_entry(entry_id):
+    """Put a write that gave up back in the queue"""
+    update_outbox_entry(entry_id, status="pending", attempts=0, next_attempt_at=0, error=None)
+    get_outbox_signal().set()
+
+def deliver_outbox_entry(entry):
+    """Send one queued write to the Apps Script"""
+    if entry["kind"] == "row":
+        return post_row(entry["sheets"][0], entry["payload"], idem_key=entry["idem_key"])
+    return post_batch(entry["payload"], idem_key=entry["idem_key"])
+
+def drain_outbox():
+    """Send every due write, oldest first, keeping per-sheet order"""
+    blocked = set()
+    now = time.time()
+    for entry in get_outbox_entries(statuses=("pending", "failed")):
+        sheets = set(entry["sheets"])
+        if entry["status"] == "failed" or sheets & blocked:
+            continue
+        if entry["next_attempt_at"] > now:
+            blocked |= sheets
+            continue
+        
+        try:
+            delivered = deliver_outbox_entry(entry)
+            error = None if delivered else "Rejected by Apps Script"
+        except Exception as e:
+            delivered = False
+            error = str(e)
+        
+        if delivered:
+            update_outbox_entry(entry["id"], status="synced", synced_at=time.time(), error=None)
+            continue
+        
+        attempts = entry["attempts"] + 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            # Stop retrying and stop holding back the rest of the sheet
+            update_outbox_entry(entry["id"], status="failed", attempts=attempts, error=error)
         else:
-            new_qty = current_qty + qty_change
-        
-        if new_qty < 0:
-            st.error(f"❌ Insufficient stock for {item_name}!")
+            update_outbox_entry(entry["id"], attempts=attempts, error=error,
+                                next_attempt_at=time.time() + backoff_delay(attempts, OUTBOX_BACKOFF_BASE, OUTBOX_BACKOFF_CAP))
+            blocked |= sheets
+    
+    with closing(outbox_connect()) as conn:
+        conn.execute("DELETE FROM outbox WHERE status = 'synced' AND synced_at < ?", (now - OUTBOX_KEEP_SYNCED,))
+        conn.commit()
+
+@st.cache_resource
+def start_write_behind():
+    """Start the background worker that drains the outbox"""
+    signal = get_outbox_signal()
+    
+    def worker_loop():
+        while True:
+            try:
+                drain_outbox()
+            except Exception:
+                pass
+            signal.wait(OUTBOX_POLL_INTERVAL)
+            signal.clear()
+    
+    thread = threading.Thread(target=worker_loop, name="sheet-write-behind", daemon=True)
+    thread.start()
+    return thread
+
+# --- BILL COMMIT JOURNAL ---
+# A bill is staged locally first, then applied in an order that can be undone:
+# stock changes (one all-or-nothing request, reversible with opposite deltas)
+# before the bill rows (queued as one outbox batch, which cannot be taken back).
+BILL_OPEN_STATUSES = ("staged", "stock_applied", "unknown", "needs_attention")
+
+def journal_connect():
+    """Open the bill journal (kept in the mirror database)"""
+    conn = mirror_connect()
+    conn.execute("""CREATE TABLE IF NOT EXISTS bill_journal (
+        bill_key TEXT PRIMARY KEY, created_at REAL, status TEXT, customer TEXT,
+        rows TEXT, stock TEXT, stock_done INTEGER, error TEXT)""")
+    return conn
+
+def get_journal_bill(bill_key):
+    """Return a journaled bill as a dict, or None"""
+    with closing(journal_connect()) as conn:
+        row = conn.execute("SELECT bill_key, created_at, status, customer, rows, stock, stock_done, error "
+                           "FROM bill_journal WHERE bill_key = ?", (bill_key,)).fetchone()
+    if row is None:
+        return None
+    return {
+        "bill_key": row[0], "created_at": row[1], "status": row[2], "customer": row[3],
+        "rows": json.loads(row[4]), "stock": json.loads(row[5]), "stock_done": row[6], "error": row[7]
+    }
+
+def update_journal_bill(bill_key, **fields):
+    """Persist progress of a journaled bill"""
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with closing(journal_connect()) as conn:
+        conn.execute(f"UPDATE bill_journal SET {assignments} WHERE bill_key = ?", (*fields.values(), bill_key))
+        conn.commit()
+
+def bill_ref(entry):
+    """Bill ID of a journaled bill, recorded as the Ref of its stock movements"""
+    headers = entry["rows"].get("BillHeaders")
+    return headers[0][0] if headers else entry["bill_key"]
+
+def stage_bill(bill_key, customer, bill_rows, stock_changes):
+    """Record every effect of a bill before anything is sent.
+    An unresolved earlier attempt with the same key is kept so it is rolled forward, not re-entered."""
+    existing = get_journal_bill(bill_key)
+    if existing and existing["status"] in BILL_OPEN_STATUSES + ("committed",):
+        return existing
+    with closing(journal_connect()) as conn:
+        conn.execute("INSERT OR REPLACE INTO bill_journal VALUES (?, ?, 'staged', ?, ?, ?, 0, NULL)",
+                     (bill_key, time.time(), customer, json.dumps(bill_rows), json.dumps(stock_changes)))
+        conn.commit()
+    return get_journal_bill(bill_key)
+
+def compensate_bill(bill_key, reason):
+    """Undo the stock change of a bill whose rows were not written"""
+    entry = get_journal_bill(bill_key)
+    stock_applied = entry["stock_done"] > 0
+    try:
+        if entry["status"] == "unknown":
+            # Settle the unconfirmed request first: resending its key applies it at most once
+            stock_applied = apply_stock_deltas(stock_deltas(entry["stock"], -1), "sale", bill_ref(entry),
+                                               idem_key=f"{bill_key}-stock")
+        if stock_applied and not apply_stock_deltas(stock_deltas(entry["stock"], +1), "return", bill_ref(entry),
+                                                    idem_key=f"{bill_key}-restore"):
+            raise ValueError("rejected")
+    except Exception as e:
+        update_journal_bill(bill_key, status="needs_attention", error=f"{reason}; could not restore stock ({e})")
+        return False
+    update_journal_bill(bill_key, status="compensated", stock_done=0, error=reason)
+    return True
+
+def apply_bill(bill_key):
+    """Apply (or roll forward) a staged bill - True only when every effect is written"""
+    entry = get_journal_bill(bill_key)
+    if entry is None:
+        return False
+    if entry["status"] == "committed":
+        return True
+    
+    if entry["stock_done"] < len(entry["stock"]):
+        try:
+            applied = apply_stock_deltas(stock_deltas(entry["stock"], -1), "sale", bill_ref(entry),
+                                         idem_key=f"{bill_key}-stock")
+        except Exception as e:
+            # It may have landed - Retry resends the same key, which is safe
+            update_journal_bill(bill_key, status="unknown", error=f"Stock update not confirmed: {e}")
             return False
-        
-        payload = {
-            "action": "update_stock",
-            "item_name": item_name,
-            "new_qty": new_qty
-        }
-        
-        response = requests.post(SCRIPT_URL, json=payload, timeout=15)
-        response_text = response.text.strip()
-        
-        if "SUCCESS" in response_text:
-            return True
-        else:
+        if not applied:
+            update_journal_bill(bill_key, status="compensated", error="Stock update rejected")
             return False
-            
+        update_journal_bill(bill_key, status="stock_applied", stock_done=len(entry["stock"]))
+    
+    try:
+        # Once in the outbox the rows are on disk and will reach Google
+        enqueue_write("batch", [name for name, rows in entry["rows"].items() if rows], entry["rows"],
+                      idem_key=f"{bill_key}-rows")
     except Exception as e:
-        st.error(f"Stock update error: {str(e)}")
+        compensate_bill(bill_key, f"Could not queue bill rows: {e}")
         return False
+    
+    update_journal_bill(bill_key, status="committed", error=None)
+    for row in entry["rows"].get("Balances", []):
+        remember_balance(row)
+    return True
+
+def get_open_bills():
+    """Journaled bills that are neither committed nor fully compensated"""
+    with closing(journal_connect()) as conn:
+        keys = conn.execute(f"SELECT bill_key FROM bill_journal WHERE status IN ({','.join('?' * len(BILL_OPEN_STATUSES))}) "
+                            "ORDER BY created_at", BILL_OPEN_STATUSES).fetchall()
+    return [get_journal_bill(key) for (key,) in keys]
+
+# --- BILL INDEX ---
+# Every bill has an ID, a BillHeaders row (totals, discount, redeem, payment
+# split, cashier) and one Bills row per item carrying the same ID. Bills rows
+# from before IDs are grouped into bills by consecutive date/customer/phone.
+BILL_HEADER_FIELDS = ["Total", "Discount", "Redeemed", "Final", "Cash", "Online", "Due", "Points", "Cashier"]
+
+def make_bill_id(bill_date, bill_key):
+    """Readable bill ID, fixed for a cart so a retried bill keeps its ID"""
+    return f"B{bill_date.strftime('%y%m%d')}-{bill_key[:6].upper()}"
+
+def build_bill_index(head_df, bills_df):
+    """Bills by ID in date order, with the Bills row positions of each one's lines"""
+    columns = ["Date", "Customer", "Phone"] + BILL_HEADER_FIELDS + ["Lines", "Day"]
+    empty = {"bills": pd.DataFrame(columns=columns), "lines": {}, "by_customer": {},
+             "days": np.array([], dtype=np.int64), "lines_df": bills_df}
+    if bills_df.empty:
+        return empty
+    
+    # Lines without an ID: a new legacy bill starts wherever date/customer/phone change
+    legacy = bills_df['BillID'].isna() | (bills_df['BillID'].astype(str).str.strip() == "")
+    who = bills_df['Date'].astype(str) + "|" + bills_df['Customer'].astype(str) + "|" + bills_df['Phone'].astype(str)
+    starts = legacy & (~legacy.shift(fill_value=False) | (who != who.shift()))
+    positions = pd.Series(np.arange(len(bills_df)), index=bills_df.index)
+    legacy_ids = ("L" + (positions + 1).astype(str)).where(starts).ffill()
+    bill_ids = bills_df['BillID'].astype(str).str.strip().where(~legacy, legacy_ids)
+    
+    groups = bills_df.assign(BillID=bill_ids.to_numpy(), Position=positions.to_numpy()).groupby('BillID', sort=False)
+    bills = groups.agg(Date=('Date', 'first'), Customer=('Customer', 'first'), Phone=('Phone', 'first'),
+                       Total=('Amount', 'sum'), Lines=('Amount', 'size'), First=('Position', 'first'))
+    bills["Final"] = bills["Total"]
+    
+    if not head_df.empty:
+        headers = head_df.dropna(subset=['BillID']).drop_duplicates('BillID', keep='last')
+        headers = headers.set_index(headers['BillID'].astype(str).str.strip())
+        bills = bills.join(headers[BILL_HEADER_FIELDS], how='left', rsuffix='_header')
+        for field in ["Total", "Final"]:
+            bills[field] = bills[f"{field}_header"].fillna(bills[field])
+    bills = bills.reindex(columns=columns + ["First"])
+    
+    bills["Day"] = pd.to_datetime(bills['Date'], errors='coerce').to_numpy().astype('datetime64[D]').astype(np.int64)
+    bills = bills.sort_values(["Day", "First"], kind="stable").drop(columns="First")
+    by_customer = {}
+    for bill_id, customer in zip(bills.index, bills['Customer']):
+        by_customer.setdefault(normalize_item(customer), []).append(bill_id)
+    return {"bills": bills, "lines": groups.indices, "by_customer": by_customer,
+            "days": bills["Day"].to_numpy(), "lines_df": bills_df}
+
+def get_bill_index():
+    """Bill index for the current BillHeaders and Bills sheets"""
+    return get_sheets_index(["BillHeaders", "Bills"], build_bill_index)
+
+def day_number(day):
+    """Day count of a date, as stored in the bill index"""
+    return np.datetime64(day, 'D').astype(np.int64)
+
+def get_bill(bill_id, index=None):
+    """Header of one bill as a Series, or None"""
+    index = index or get_bill_index()
+    if bill_id not in index["lines"]:
+        return None
+    return index["bills"].loc[bill_id]
+
+def bill_lines(bill_id, index=None):
+    """Item rows of one bill"""
+    index = index or get_bill_index()
+    return index["lines_df"].iloc[index["lines"].get(bill_id, [])]
+
+def bills_for_customer(customer, index=None):
+    """Headers of a customer's bills, oldest first"""
+    index = index or get_bill_index()
+    return index["bills"].loc[index["by_customer"].get(normalize_item(customer), [])]
+
+def bills_between(date_from, date_to, index=None):
+    """Headers of the bills dated between two dates (inclusive), oldest first"""
+    index = index or get_bill_index()
+    lo = np.searchsorted(index["days"], day_number(date_from), side="left")
+    hi = np.searchsorted(index["days"], day_number(date_to), side="right")
+    return index["bills"].iloc[lo:hi]
 
 def get_balance_from_sheet(mode):
     """Get balance from Google Sheets"""
     try:
         b_df = load_data("Balances")
-        if b_df.empty or len(b_df.columns) < 2:
+        if b_df.empty:
             return 0.0
         
-        rows = b_df[b_df.iloc[:, 0].str.strip() == mode]
+        rows = b_df[b_df['Mode'].str.strip() == mode]
         
         if len(rows) > 0:
-            latest_balance = rows.iloc[-1, 1]
-            return float(pd.to_numeric(latest_balance, errors='coerce'))
+            return float(rows['Balance'].iloc[-1])
         
         return 0.0
     except:
@@ -168,6 +1687,21 @@ def get_current_balance(mode):
         return st.session_state.manual_online
     return 0.0
 
+def balance_row(amount, mode, operation='add'):
+    """Balances row for an update, without saving it - pair with remember_balance"""
+    current_bal = get_current_balance(mode)
+    if operation == 'add':
+        return [mode, current_bal + amount]
+    return [mode, current_bal - amount]
+
+def remember_balance(row):
+    """Apply a saved Balances row to the session balances"""
+    mode, new_bal = row
+    if mode == "Cash":
+        st.session_state.manual_cash = new_bal
+    elif mode == "Online":
+        st.session_state.manual_online = new_bal
+
 def update_balance(amount, mode, operation='add'):
     """Update balance"""
     if mode not in ["Cash", "Online"]:
@@ -214,32 +1748,30 @@ def get_customer_loyalty_points(customer_name):
         if loyalty_df.empty:
             return 0
         
-        customer_rows = loyalty_df[loyalty_df.iloc[:, 0].str.strip().str.upper() == customer_name.strip().upper()]
+        customer_rows = loyalty_df[loyalty_df['Customer'].str.strip().str.upper() == customer_name.strip().upper()]
         if customer_rows.empty:
             return 0
         
-        total_points = pd.to_numeric(customer_rows.iloc[:, 1], errors='coerce').sum()
+        total_points = customer_rows['Points'].sum()
         return int(total_points)
     except:
         return 0
 
 def get_item_purchase_rate(item_name):
-    """Get the purchase rate of an item from inventory"""
+    """Get the average purchase cost of an item from its inventory lots"""
     try:
-        inv_df = load_data("Inventory")
-        if inv_df.empty:
-            return 0.0
-        
-        item_rows = inv_df[inv_df.iloc[:, 0].str.strip().str.upper() == item_name.strip().upper()]
-        if item_rows.empty:
-            return 0.0
-        
-        latest_row = item_rows.iloc[-1]
-        purchase_rate = float(pd.to_numeric(latest_row.iloc[3], errors='coerce'))
+        # Weighted average over every lot, so margins don't swing with each purchase
+        purchase_rate = float(average_cost([normalize_item(item_name)])[0])
+        if purchase_rate == 0:
+            record = get_inventory_item(item_name)
+            purchase_rate = float(record["rate"]) if record else 0.0
         return purchase_rate
     except:
         return 0.0
 
+start_mirror_sync()
+start_write_behind()
+
 # --- MULTI-USER LOGIN ---
 if 'logged_in' not in st.session_state: 
     st.session_state.logged_in = False
@@ -335,6 +1867,25 @@ menu = st.session_state.selected_menu
 
 st.sidebar.divider()
 
+# Write-behind sync status
+sync_counts = get_outbox_counts()
+pending_count = sync_counts.get("pending", 0)
+failed_count = sync_counts.get("failed", 0)
+with st.sidebar.expander(f"🔄 Sync ({pending_count} pending, {failed_count} failed)", expanded=failed_count > 0):
+    sync_entries = get_outbox_entries(limit=15)
+    if not sync_entries:
+        st.caption("Nothing saved yet")
+    for entry in sync_entries:
+        icon = {"pending": "⏳", "synced": "✅", "failed": "❌"}[entry["status"]]
+        saved_at = datetime.fromtimestamp(entry["created_at"]).strftime("%H:%M:%S")
+        st.caption(f"{icon} {', '.join(entry['sheets'])} - {saved_at}"
+                   + (f" - {entry['error']}" if entry["error"] and entry["status"] != "synced" else ""))
+        if entry["status"] == "failed" and st.button("🔁 Retry", key=f"retry_outbox_{entry['id']}"):
+            retry_outbox_entry(entry["id"])
+            st.rerun()
+    if pending_count and st.button("🔄 Refresh", key="refresh_sync_status"):
+        st.rerun()
+
 if st.sidebar.button("🚪 Logout", use_container_width=True):
     st.session_state.logged_in = False
     st.session_state.user_role = None
@@ -352,6 +1903,9 @@ if menu == "📊 Dashboard":
     </div>
     """, unsafe_allow_html=True)
     
+    # Fetch everything the dashboard reads at once; later load_data calls reuse it
+    load_many(["Balances", "HandInvestments", "CustomerKhata", "Inventory", "StockLedger", "StockSnapshots"])
+    
     cash_bal = get_current_balance("Cash")
     online_bal = get_current_balance("Online")
     total_bal = cash_bal + online_bal
@@ -360,30 +1914,21 @@ if menu == "📊 Dashboard":
     total_hand_investment = 0
     try:
         hand_df = load_data("HandInvestments")
-        if not hand_df.empty and len(hand_df.columns) > 2:
-            hand_amounts = pd.to_numeric(hand_df.iloc[:, 2], errors='coerce').fillna(0)
-            total_hand_investment = hand_amounts.sum()
+        if not hand_df.empty:
+            total_hand_investment = hand_df['Amount'].sum()
     except:
         total_hand_investment = 0
     
     # Customer Due
     k_df = load_data("CustomerKhata")
-    if not k_df.empty and len(k_df.columns) > 1:
-        customer_due = k_df.groupby(k_df.columns[0])[k_df.columns[1]].sum()
+    if not k_df.empty:
+        customer_due = k_df.groupby('Customer')['Amount'].sum()
         total_customer_due = customer_due[customer_due > 0].sum()
     else:
         total_customer_due = 0
     
     # Stock Value
-    inv_df = load_data("Inventory")
-    if not inv_df.empty and len(inv_df.columns) > 3:
-        latest_stock = inv_df.groupby(inv_df.iloc[:, 0]).tail(1)
-        latest_stock['qty_val'] = pd.to_numeric(latest_stock.iloc[:, 1], errors='coerce').fillna(0)
-        latest_stock['rate_val'] = pd.to_numeric(latest_stock.iloc[:, 3], errors='coerce').fillna(0)
-        latest_stock['total_val'] = latest_stock['qty_val'] * latest_stock['rate_val']
-        total_stock_value = latest_stock['total_val'].sum()
-    else:
-        total_stock_value = 0
+    total_stock_value = current_stock_table()['Value'].sum()
     
     st.markdown(f"""
     <div style="display: flex; gap: 15px; margin-bottom: 30px;">
@@ -446,6 +1991,7 @@ if menu == "📊 Dashboard":
                 if st.button("🔄 Refresh All Data", key="refresh_data", use_container_width=True):
                     st.session_state.manual_cash = None
                     st.session_state.manual_online = None
+                    invalidate_sheets()
                     st.success("✅ Data refreshed!")
                     time.sleep(0.5)
                     st.rerun()
@@ -454,28 +2000,9 @@ if menu == "📊 Dashboard":
     st.divider()
     st.subheader("📅 Today's Report")
     
-    bills_df = load_data("Bills")
-    purchase_df = load_data("Purchases")
-    expense_df = load_data("Expenses")
-    
-    today_sales = 0
-    today_purchase = 0
-    today_expense = 0
-    
-    if not bills_df.empty and 'Date' in bills_df.columns:
-        today_bills = bills_df[bills_df['Date'] == today_dt]
-        if len(today_bills.columns) > 6:
-            today_sales = pd.to_numeric(today_bills.iloc[:, 6], errors='coerce').sum()
-    
-    if not purchase_df.empty and 'Date' in purchase_df.columns:
-        today_purchases = purchase_df[purchase_df['Date'] == today_dt]
-        if len(today_purchases.columns) > 5:
-            today_purchase = pd.to_numeric(today_purchases.iloc[:, 5], errors='coerce').sum()
-    
-    if not expense_df.empty and 'Date' in expense_df.columns:
-        today_expenses = expense_df[expense_df['Date'] == today_dt]
-        if len(today_expenses.columns) > 2:
-            today_expense = pd.to_numeric(today_expenses.iloc[:, 2], errors='coerce').sum()
+    today_sales = sheet_total("Bills", "Amount", today_dt, today_dt)
+    today_purchase = sheet_total("Purchases", "Amount", today_dt, today_dt)
+    today_expense = sheet_total("Expenses", "Amount", today_dt, today_dt)
     
     today_profit = today_sales - today_purchase - today_expense
     
@@ -553,30 +2080,12 @@ if menu == "📊 Dashboard":
     st.divider()
     st.subheader("📊 Monthly Report")
     
-    current_month = today_dt.month
-    current_year = today_dt.year
-    
-    month_sales = 0
-    month_purchase = 0
-    month_expense = 0
-    
-    if not bills_df.empty and 'Date' in bills_df.columns:
-        month_bills = bills_df[(bills_df['Date'].apply(lambda x: x.month if pd.notna(x) else 0) == current_month) & 
-                               (bills_df['Date'].apply(lambda x: x.year if pd.notna(x) else 0) == current_year)]
-        if len(month_bills.columns) > 6:
-            month_sales = pd.to_numeric(month_bills.iloc[:, 6], errors='coerce').sum()
+    month_start = today_dt.replace(day=1)
+    month_end = (month_start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
     
-    if not purchase_df.empty and 'Date' in purchase_df.columns:
-        month_purchases = purchase_df[(purchase_df['Date'].apply(lambda x: x.month if pd.notna(x) else 0) == current_month) & 
-                                      (purchase_df['Date'].apply(lambda x: x.year if pd.notna(x) else 0) == current_year)]
-        if len(month_purchases.columns) > 5:
-            month_purchase = pd.to_numeric(month_purchases.iloc[:, 5], errors='coerce').sum()
-    
-    if not expense_df.empty and 'Date' in expense_df.columns:
-        month_expenses = expense_df[(expense_df['Date'].apply(lambda x: x.month if pd.notna(x) else 0) == current_month) & 
-                                    (expense_df['Date'].apply(lambda x: x.year if pd.notna(x) else 0) == current_year)]
-        if len(month_expenses.columns) > 2:
-            month_expense = pd.to_numeric(month_expenses.iloc[:, 2], errors='coerce').sum()
+    month_sales = sheet_total("Bills", "Amount", month_start, month_end)
+    month_purchase = sheet_total("Purchases", "Amount", month_start, month_end)
+    month_expense = sheet_total("Expenses", "Amount", month_start, month_end)
     
     month_profit = month_sales - month_purchase - month_expense
     
@@ -612,6 +2121,26 @@ elif menu == "🧾 Billing":
     tab1, tab2 = st.tabs(["➕ New Bill", "📜 Bill History"])
     
     with tab1:
+        # Bills interrupted mid-commit must be finished or undone, never re-entered
+        open_bills = get_open_bills()
+        if open_bills:
+            with st.expander(f"⏳ Pending Bills ({len(open_bills)})", expanded=True):
+                for entry in open_bills:
+                    bill_total = sum(row[6] for row in entry["rows"].get("Bills", []))
+                    col1, col2, col3 = st.columns([4, 1, 1])
+                    col1.write(f"**{entry['customer']}** - ₹{bill_total:,.2f} - {entry['status']}"
+                               + (f" ({entry['error']})" if entry['error'] else ""))
+                    if col2.button("🔁 Retry", key=f"retry_bill_{entry['bill_key']}"):
+                        if apply_bill(entry["bill_key"]):
+                            st.success("✅ Bill completed!")
+                        st.rerun()
+                    if col3.button("↩️ Undo", key=f"undo_bill_{entry['bill_key']}",
+                                   help="Restores stock. Only use if the bill rows are NOT in the Bills sheet."):
+                        if compensate_bill(entry["bill_key"], "Cancelled by user") and entry["bill_key"] == st.session_state.bill_cart_id:
+                            # Billing the cart again is a new attempt with new keys
+                            st.session_state.bill_cart_id = uuid.uuid4().hex
+                        st.rerun()
+        
         st.subheader("Create New Bill")
         
         col1, col2 = st.columns(2)
@@ -623,497 +2152,561 @@ elif menu == "🧾 Billing":
         with col2:
             bill_date = st.date_input("📅 Bill Date", value=today_dt, key="bill_date")
         
-        st.divider()
-        st.subheader("Add Items to Bill")
-        
-        # Load inventory for item selection
-        inv_df = load_data("Inventory")
-        if not inv_df.empty:
-            item_list = inv_df.iloc[:, 0].unique().tolist()
-            
-            col1, col2, col3, col4 = st.columns([3, 2, 2, 1])
-            
-            with col1:
-                selected_item = st.selectbox("Select Item", [""] + item_list, key="bill_item")
-            
-            # Show purchase rate when item is selected
-            if selected_item:
-                purchase_rate = get_item_purchase_rate(selected_item)
-                st.info(f"💡 **Purchase Rate:** ₹{purchase_rate:.2f} | You can set your selling price below")
-            
-            with col2:
-                item_qty = st.number_input("Quantity (Kg/Pcs)", min_value=0.0, value=1.0, step=0.5, key="bill_qty")
+        # Item entry, cart, discount, payment and loyalty rerun on their own,
+        # so editing the cart doesn't redraw the whole page
+        @st.fragment
+        def bill_cart_section(cust_name, cust_phone, bill_date):
+            """Items and checkout of the bill being made"""
+            st.divider()
+            st.subheader("Add Items to Bill")
             
-            with col3:
-                # Set default selling rate slightly higher than purchase rate if available
-                default_rate = 0.0
+            # Load inventory for item selection
+            inventory_index = get_inventory_index()
+            if inventory_index:
+                # Scanner input ends with Enter, which adds the item straight to the cart
+                st.text_input("📷 Scan Barcode / SKU", placeholder="Scan, or type 3*CODE for quantity",
+                              key="bill_scan", on_change=add_scanned_item)
+                if "bill_scan_msg" in st.session_state:
+                    level, message = st.session_state.pop("bill_scan_msg")
+                    getattr(st, level)(message)
+                
+                col1, col2, col3, col4 = st.columns([3, 2, 2, 1])
+                
+                with col1:
+                    item_query = st.text_input("🔍 Search Item", placeholder="Name, alias or supplier", key="bill_item_search")
+                    selected_item = st.selectbox("Select Item", [""] + search_items(item_query), key="bill_item")
+                
+                # Show purchase rate when item is selected
+                purchase_rate = get_item_purchase_rate(selected_item) if selected_item else 0.0
                 if selected_item:
-                    purchase_rate = get_item_purchase_rate(selected_item)
-                    default_rate = purchase_rate * 1.2  # 20% markup as default suggestion
+                    record = inventory_index[normalize_item(selected_item)]
+                    in_stock = get_current_stock().get(normalize_item(selected_item), 0)
+                    st.info(f"💡 **Purchase Rate:** ₹{purchase_rate:.2f} | **In Stock:** {in_stock:g} {record['unit']} | You can set your selling price below")
                 
-                item_rate = st.number_input("Selling Rate per unit", min_value=0.0, value=default_rate, step=1.0, key="bill_rate")
-            
-            # Show profit margin
-            if selected_item and item_rate > 0:
-                purchase_rate = get_item_purchase_rate(selected_item)
-                profit_per_unit = item_rate - purchase_rate
-                profit_margin = ((profit_per_unit / item_rate) * 100) if item_rate > 0 else 0
+                with col2:
+                    item_qty = st.number_input("Quantity (Kg/Pcs)", min_value=0.0, value=1.0, step=0.5, key="bill_qty")
                 
-                if profit_per_unit > 0:
-                    st.success(f"📈 Profit: ₹{profit_per_unit:.2f}/unit ({profit_margin:.1f}% margin)")
-                elif profit_per_unit < 0:
-                    st.error(f"⚠️ Loss: ₹{abs(profit_per_unit):.2f}/unit (Selling below cost!)")
-                else:
-                    st.warning("⚠️ No profit - Selling at cost price")
-            
-            with col4:
-                st.write("")
-                st.write("")
-                if st.button("➕ Add", key="add_bill_item"):
-                    if selected_item and item_qty > 0 and item_rate > 0:
-                        # Get purchase rate for profit calculation
-                        purchase_rate = get_item_purchase_rate(selected_item)
-                        
-                        st.session_state.bill_cart.append({
-                            'Item': selected_item,
-                            'Qty': item_qty,
-                            'Rate': item_rate,
-                            'Amount': item_qty * item_rate,
-                            'Purchase_Rate': purchase_rate
-                        })
-                        st.success(f"✅ {selected_item} added to cart!")
-                        st.rerun()
+                with col3:
+                    # Set default selling rate slightly higher than purchase rate if available
+                    default_rate = purchase_rate * 1.2  # 20% markup as default suggestion
+                    
+                    item_rate = st.number_input("Selling Rate per unit", min_value=0.0, value=default_rate, step=1.0, key="bill_rate")
+                
+                # Show profit margin
+                if selected_item and item_rate > 0:
+                    profit_per_unit = item_rate - purchase_rate
+                    profit_margin = ((profit_per_unit / item_rate) * 100) if item_rate > 0 else 0
+                    
+                    if profit_per_unit > 0:
+                        st.success(f"📈 Profit: ₹{profit_per_unit:.2f}/unit ({profit_margin:.1f}% margin)")
+                    elif profit_per_unit < 0:
+                        st.error(f"⚠️ Loss: ₹{abs(profit_per_unit):.2f}/unit (Selling below cost!)")
                     else:
-                        st.error("Please fill all fields!")
-        
-        # Display Cart
-        if st.session_state.bill_cart:
-            st.divider()
-            st.subheader("🛒 Cart Items")
-            
-            cart_df = pd.DataFrame(st.session_state.bill_cart)
-            
-            for idx, row in cart_df.iterrows():
-                col1, col2, col3, col4, col5 = st.columns([3, 2, 2, 2, 1])
-                col1.write(f"**{row['Item']}**")
-                col2.write(f"{row['Qty']} units")
-                col3.write(f"₹{row['Rate']:.2f}/unit")
-                col4.write(f"₹{row['Amount']:.2f}")
+                        st.warning("⚠️ No profit - Selling at cost price")
                 
-                if col5.button("🗑️", key=f"del_bill_{idx}"):
-                    st.session_state.bill_cart.pop(idx)
-                    st.rerun()
-            
-            total_amount = cart_df['Amount'].sum()
-            
-            st.markdown(f"""
-            <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 20px; border-radius: 12px; text-align: center; color: white; margin: 20px 0;">
-                <h2 style="margin: 0;">Total Amount: ₹{total_amount:,.2f}</h2>
-            </div>
-            """, unsafe_allow_html=True)
+                with col4:
+                    st.write("")
+                    st.write("")
+                    if st.button("➕ Add", key="add_bill_item"):
+                        if selected_item and item_qty > 0 and item_rate > 0:
+                            st.session_state.bill_cart.append({
+                                'Item': selected_item,
+                                'Qty': item_qty,
+                                'Rate': item_rate,
+                                'Amount': item_qty * item_rate,
+                                'Purchase_Rate': purchase_rate
+                            })
+                            st.success(f"✅ {selected_item} added to cart!")
+                        else:
+                            st.error("Please fill all fields!")
             
-            # Manual Discount Option
-            st.divider()
-            st.subheader("💰 Discount (Optional)")
-            
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                discount_type = st.selectbox("Discount Type", 
-                                            ["No Discount", "Percentage (%)", "Flat Amount (₹)"],
-                                            key="discount_type")
-            
-            discount_value = 0
-            discount_amount = 0
-            
-            if discount_type == "Percentage (%)":
-                with col2:
-                    discount_value = st.number_input("Discount %", min_value=0.0, max_value=100.0, value=10.0, step=1.0, key="discount_percent")
-                    discount_amount = (total_amount * discount_value) / 100
-            
-            elif discount_type == "Flat Amount (₹)":
-                with col2:
-                    discount_amount = st.number_input("Discount ₹", min_value=0.0, max_value=float(total_amount), value=0.0, step=10.0, key="discount_flat")
-            
-            if discount_amount > 0:
-                discount_reason = st.text_input("Discount Reason", placeholder="e.g., Regular customer, Festival offer", key="discount_reason")
-                st.info(f"💡 Discount Applied: ₹{discount_amount:,.2f}")
-            else:
-                discount_reason = ""
-            
-            # Calculate amount after discount
-            amount_after_discount = total_amount - discount_amount
-            
-            if discount_amount > 0:
+            # Display Cart
+            if st.session_state.bill_cart:
+                st.divider()
+                st.subheader("🛒 Cart Items")
+                
+                cart_df = pd.DataFrame(st.session_state.bill_cart)
+                
+                for idx, row in cart_df.iterrows():
+                    col1, col2, col3, col4, col5 = st.columns([3, 2, 2, 2, 1])
+                    col1.write(f"**{row['Item']}**")
+                    col2.write(f"{row['Qty']} units")
+                    col3.write(f"₹{row['Rate']:.2f}/unit")
+                    col4.write(f"₹{row['Amount']:.2f}")
+                    
+                    # Removed in the click's callback, before the cart is drawn again
+                    col5.button("🗑️", key=f"del_bill_{idx}", on_click=st.session_state.bill_cart.pop, args=(idx,))
+                
+                total_amount = cart_df['Amount'].sum()
+                
                 st.markdown(f"""
-                <div style="background: linear-gradient(135deg, #43e97b 0%, #38f9d7 100%); padding: 15px; border-radius: 10px; text-align: center; color: white; margin: 10px 0;">
-                    <h3 style="margin: 0;">Amount to Pay: ₹{amount_after_discount:,.2f}</h3>
+                <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 20px; border-radius: 12px; text-align: center; color: white; margin: 20px 0;">
+                    <h2 style="margin: 0;">Total Amount: ₹{total_amount:,.2f}</h2>
                 </div>
                 """, unsafe_allow_html=True)
-            
-            # Payment Details
-            st.divider()
-            st.subheader("💳 Payment Details")
-            
-            # Initialize all payment variables with default values
-            cash_paid = 0.0
-            online_paid = 0.0
-            due_amount_adjusted = 0.0
-            cash_paid_adjusted = 0.0
-            online_paid_adjusted = 0.0
-            
-            # Payment Mode Selection
-            payment_mode = st.radio(
-                "Select Payment Mode",
-                ["💵 Cash", "🏦 Online", "📒 Due (Credit)"],
-                horizontal=True,
-                key="bill_payment_mode"
-            )
-            
-            # Set amounts based on payment mode
-            if payment_mode == "💵 Cash":
-                cash_paid = amount_after_discount
-                online_paid = 0.0
-                due_amount_adjusted = 0.0
-                st.success(f"✅ Cash Payment: ₹{cash_paid:,.2f}")
-            
-            elif payment_mode == "🏦 Online":
-                cash_paid = 0.0
-                online_paid = amount_after_discount
-                due_amount_adjusted = 0.0
-                st.success(f"✅ Online Payment: ₹{online_paid:,.2f}")
-            
-            else:  # Due/Credit
+                
+                # Manual Discount Option
+                st.divider()
+                st.subheader("💰 Discount (Optional)")
+                
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    discount_type = st.selectbox("Discount Type", 
+                                                ["No Discount", "Percentage (%)", "Flat Amount (₹)"],
+                                                key="discount_type")
+                
+                discount_value = 0
+                discount_amount = 0
+                
+                if discount_type == "Percentage (%)":
+                    with col2:
+                        discount_value = st.number_input("Discount %", min_value=0.0, max_value=100.0, value=10.0, step=1.0, key="discount_percent")
+                        discount_amount = (total_amount * discount_value) / 100
+                
+                elif discount_type == "Flat Amount (₹)":
+                    with col2:
+                        discount_amount = st.number_input("Discount ₹", min_value=0.0, max_value=float(total_amount), value=0.0, step=10.0, key="discount_flat")
+                
+                if discount_amount > 0:
+                    discount_reason = st.text_input("Discount Reason", placeholder="e.g., Regular customer, Festival offer", key="discount_reason")
+                    st.info(f"💡 Discount Applied: ₹{discount_amount:,.2f}")
+                else:
+                    discount_reason = ""
+                
+                # Calculate amount after discount
+                amount_after_discount = total_amount - discount_amount
+                
+                if discount_amount > 0:
+                    st.markdown(f"""
+                    <div style="background: linear-gradient(135deg, #43e97b 0%, #38f9d7 100%); padding: 15px; border-radius: 10px; text-align: center; color: white; margin: 10px 0;">
+                        <h3 style="margin: 0;">Amount to Pay: ₹{amount_after_discount:,.2f}</h3>
+                    </div>
+                    """, unsafe_allow_html=True)
+                
+                # Payment Details
+                st.divider()
+                st.subheader("💳 Payment Details")
+                
+                # Initialize all payment variables with default values
                 cash_paid = 0.0
                 online_paid = 0.0
-                due_amount_adjusted = amount_after_discount
-                st.warning(f"📒 Due Amount: ₹{due_amount_adjusted:,.2f} (Will be added to customer account)")
-            
-            # Loyalty Points Section
-            st.divider()
-            st.subheader("⭐ Loyalty Points")
-            
-            # Calculate suggested points (₹100 = 2 points)
-            suggested_points = int((amount_after_discount // 100) * 2)
-            
-            # Show current points first
-            current_customer_points = 0
-            if cust_name:
-                current_customer_points = get_customer_loyalty_points(cust_name)
-            
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                st.markdown(f"""
-                <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 15px; border-radius: 10px; text-align: center; color: white;">
-                    <p style="margin: 0; font-size: 14px;">Current Points</p>
-                    <h2 style="margin: 5px 0; font-size: 32px;">{current_customer_points}</h2>
-                </div>
-                """, unsafe_allow_html=True)
-            
-            with col2:
-                st.markdown(f"""
-                <div style="background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%); padding: 15px; border-radius: 10px; text-align: center; color: white;">
-                    <p style="margin: 0; font-size: 14px;">Suggested Points</p>
-                    <h2 style="margin: 5px 0; font-size: 32px;">{suggested_points}</h2>
-                    <p style="margin: 0; font-size: 12px; opacity: 0.9;">₹100 = 2 points</p>
-                </div>
-                """, unsafe_allow_html=True)
-            
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                loyalty_points = st.number_input("Points to Give", 
-                                                min_value=0, 
-                                                value=suggested_points, 
-                                                step=1, 
-                                                key="bill_loyalty_points", 
-                                                help="Change if you want to give more/less points")
-            
-            with col2:
-                loyalty_reason = st.text_input("Reason (Optional)", value="Purchase", key="bill_loyalty_reason",
-                                              placeholder="e.g., Purchase, Special Offer")
-            
-            # Redeem Points Option
-            st.divider()
-            use_redeem = st.checkbox("🎁 Redeem Loyalty Points", key="use_redeem")
-            
-            # Initialize redeem variables
-            redeem_points = 0
-            redeem_value = 0
-            
-            if use_redeem and current_customer_points > 0:
+                due_amount_adjusted = 0.0
+                cash_paid_adjusted = 0.0
+                online_paid_adjusted = 0.0
+                
+                # Payment Mode Selection
+                payment_mode = st.radio(
+                    "Select Payment Mode",
+                    ["💵 Cash", "🏦 Online", "📒 Due (Credit)"],
+                    horizontal=True,
+                    key="bill_payment_mode"
+                )
+                
+                # Set amounts based on payment mode
+                if payment_mode == "💵 Cash":
+                    cash_paid = amount_after_discount
+                    online_paid = 0.0
+                    due_amount_adjusted = 0.0
+                    st.success(f"✅ Cash Payment: ₹{cash_paid:,.2f}")
+                
+                elif payment_mode == "🏦 Online":
+                    cash_paid = 0.0
+                    online_paid = amount_after_discount
+                    due_amount_adjusted = 0.0
+                    st.success(f"✅ Online Payment: ₹{online_paid:,.2f}")
+                
+                else:  # Due/Credit
+                    cash_paid = 0.0
+                    online_paid = 0.0
+                    due_amount_adjusted = amount_after_discount
+                    st.warning(f"📒 Due Amount: ₹{due_amount_adjusted:,.2f} (Will be added to customer account)")
+                
+                # Loyalty Points Section
+                st.divider()
+                st.subheader("⭐ Loyalty Points")
+                
+                # Calculate suggested points (₹100 = 2 points)
+                suggested_points = int((amount_after_discount // 100) * 2)
+                
+                # Show current points first
+                current_customer_points = 0
+                if cust_name:
+                    current_customer_points = get_customer_loyalty_points(cust_name)
+                
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    st.markdown(f"""
+                    <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 15px; border-radius: 10px; text-align: center; color: white;">
+                        <p style="margin: 0; font-size: 14px;">Current Points</p>
+                        <h2 style="margin: 5px 0; font-size: 32px;">{current_customer_points}</h2>
+                    </div>
+                    """, unsafe_allow_html=True)
+                
+                with col2:
+                    st.markdown(f"""
+                    <div style="background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%); padding: 15px; border-radius: 10px; text-align: center; color: white;">
+                        <p style="margin: 0; font-size: 14px;">Suggested Points</p>
+                        <h2 style="margin: 5px 0; font-size: 32px;">{suggested_points}</h2>
+                        <p style="margin: 0; font-size: 12px; opacity: 0.9;">₹100 = 2 points</p>
+                    </div>
+                    """, unsafe_allow_html=True)
+                
                 col1, col2 = st.columns(2)
                 
                 with col1:
-                    redeem_points = st.number_input("Points to Redeem", 
-                                                   min_value=0, 
-                                                   max_value=current_customer_points, 
-                                                   value=min(10, current_customer_points),
-                                                   step=1,
-                                                   key="redeem_points")
-                    st.info("💡 1 Point = ₹1")
+                    loyalty_points = st.number_input("Points to Give", 
+                                                    min_value=0, 
+                                                    value=suggested_points, 
+                                                    step=1, 
+                                                    key="bill_loyalty_points", 
+                                                    help="Change if you want to give more/less points")
                 
                 with col2:
-                    redeem_value = redeem_points * 1  # 1 point = 1 rupee
-                    st.metric("Discount Amount", f"₹{redeem_value}")
+                    loyalty_reason = st.text_input("Reason (Optional)", value="Purchase", key="bill_loyalty_reason",
+                                                  placeholder="e.g., Purchase, Special Offer")
+                
+                # Redeem Points Option
+                st.divider()
+                use_redeem = st.checkbox("🎁 Redeem Loyalty Points", key="use_redeem")
+                
+                # Initialize redeem variables
+                redeem_points = 0
+                redeem_value = 0
+                
+                if use_redeem and current_customer_points > 0:
+                    col1, col2 = st.columns(2)
                     
-                    remaining_points = current_customer_points - redeem_points
-                    st.metric("Points After Redeem", f"{remaining_points}")
-            
-            # Calculate final amounts
-            final_amount = amount_after_discount - redeem_value
-            
-            # Adjust payment amounts based on redeem
-            if redeem_value > 0:
-                if payment_mode == "💵 Cash":
-                    cash_paid_adjusted = final_amount
-                    online_paid_adjusted = 0.0
-                    due_amount_adjusted = 0.0
-                elif payment_mode == "🏦 Online":
-                    cash_paid_adjusted = 0.0
-                    online_paid_adjusted = final_amount
-                    due_amount_adjusted = 0.0
-                else:  # Due
-                    cash_paid_adjusted = 0.0
-                    online_paid_adjusted = 0.0
-                    due_amount_adjusted = final_amount
-            else:
-                # No redeem, use original amounts
-                cash_paid_adjusted = cash_paid
-                online_paid_adjusted = online_paid
-                due_amount_adjusted = due_amount_adjusted
-            
-            # Show final summary
-            if redeem_value > 0 or discount_amount > 0:
-                st.markdown(f"""
-                <div style="background: linear-gradient(135deg, #43e97b 0%, #38f9d7 100%); padding: 15px; border-radius: 10px; color: white; margin: 10px 0;">
-                    <h4 style="margin: 0 0 10px 0;">Final Bill Summary</h4>
-                    <p style="margin: 0;"><strong>Original Amount:</strong> ₹{total_amount:,.2f}</p>
-                    {f'<p style="margin: 5px 0;"><strong>Manual Discount:</strong> -₹{discount_amount:,.2f}</p>' if discount_amount > 0 else ''}
-                    {f'<p style="margin: 5px 0;"><strong>Points Discount:</strong> -₹{redeem_value:,.2f} ({redeem_points} points)</p>' if redeem_value > 0 else ''}
-                    <p style="margin: 5px 0;"><strong>Final Amount:</strong> ₹{final_amount:,.2f}</p>
-                    <p style="margin: 5px 0;"><strong>Paid:</strong> ₹{cash_paid_adjusted + online_paid_adjusted:,.2f}</p>
-                    <p style="margin: 5px 0 0 0;"><strong>Due:</strong> ₹{due_amount_adjusted:,.2f}</p>
-                </div>
-                """, unsafe_allow_html=True)
-            
-            # Show points preview
-            if cust_name:
-                new_total_points = current_customer_points + loyalty_points - redeem_points
-                st.success(f"🎯 Today's Points: **+{loyalty_points}** | Redeemed: **-{redeem_points}** | Final Balance: **{new_total_points}** points")
-            
-            # Generate Bill Button
-            st.divider()
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                if st.button("✅ Generate Bill", type="primary", use_container_width=True):
-                    if not cust_name:
-                        st.error("Please enter customer name!")
-                    elif len(st.session_state.bill_cart) == 0:
-                        st.error("❌ Cart is empty! Please add items first.")
-                    else:
-                        try:
-                            # Debug info
-                            st.write("DEBUG INFO:")
-                            st.write(f"Customer: {cust_name}")
-                            st.write(f"Cart items: {len(st.session_state.bill_cart)}")
-                            st.write(f"Cash: {cash_paid_adjusted}, Online: {online_paid_adjusted}, Due: {due_amount_adjusted}")
-                            st.write(f"Points: {loyalty_points}")
-                            
-                            # Save each item to Bills sheet
-                            all_saved = True
-                            
-                            for item in st.session_state.bill_cart:
-                                bill_data = [
+                    with col1:
+                        redeem_points = st.number_input("Points to Redeem", 
+                                                       min_value=0, 
+                                                       max_value=current_customer_points, 
+                                                       value=min(10, current_customer_points),
+                                                       step=1,
+                                                       key="redeem_points")
+                        st.info("💡 1 Point = ₹1")
+                    
+                    with col2:
+                        redeem_value = redeem_points * 1  # 1 point = 1 rupee
+                        st.metric("Discount Amount", f"₹{redeem_value}")
+                        
+                        remaining_points = current_customer_points - redeem_points
+                        st.metric("Points After Redeem", f"{remaining_points}")
+                
+                # Calculate final amounts
+                final_amount = amount_after_discount - redeem_value
+                
+                # Adjust payment amounts based on redeem
+                if redeem_value > 0:
+                    if payment_mode == "💵 Cash":
+                        cash_paid_adjusted = final_amount
+                        online_paid_adjusted = 0.0
+                        due_amount_adjusted = 0.0
+                    elif payment_mode == "🏦 Online":
+                        cash_paid_adjusted = 0.0
+                        online_paid_adjusted = final_amount
+                        due_amount_adjusted = 0.0
+                    else:  # Due
+                        cash_paid_adjusted = 0.0
+                        online_paid_adjusted = 0.0
+                        due_amount_adjusted = final_amount
+                else:
+                    # No redeem, use original amounts
+                    cash_paid_adjusted = cash_paid
+                    online_paid_adjusted = online_paid
+                    due_amount_adjusted = due_amount_adjusted
+                
+                # Show final summary
+                if redeem_value > 0 or discount_amount > 0:
+                    st.markdown(f"""
+                    <div style="background: linear-gradient(135deg, #43e97b 0%, #38f9d7 100%); padding: 15px; border-radius: 10px; color: white; margin: 10px 0;">
+                        <h4 style="margin: 0 0 10px 0;">Final Bill Summary</h4>
+                        <p style="margin: 0;"><strong>Original Amount:</strong> ₹{total_amount:,.2f}</p>
+                        {f'<p style="margin: 5px 0;"><strong>Manual Discount:</strong> -₹{discount_amount:,.2f}</p>' if discount_amount > 0 else ''}
+                        {f'<p style="margin: 5px 0;"><strong>Points Discount:</strong> -₹{redeem_value:,.2f} ({redeem_points} points)</p>' if redeem_value > 0 else ''}
+                        <p style="margin: 5px 0;"><strong>Final Amount:</strong> ₹{final_amount:,.2f}</p>
+                        <p style="margin: 5px 0;"><strong>Paid:</strong> ₹{cash_paid_adjusted + online_paid_adjusted:,.2f}</p>
+                        <p style="margin: 5px 0 0 0;"><strong>Due:</strong> ₹{due_amount_adjusted:,.2f}</p>
+                    </div>
+                    """, unsafe_allow_html=True)
+                
+                # Show points preview
+                if cust_name:
+                    new_total_points = current_customer_points + loyalty_points - redeem_points
+                    st.success(f"🎯 Today's Points: **+{loyalty_points}** | Redeemed: **-{redeem_points}** | Final Balance: **{new_total_points}** points")
+                
+                # Generate Bill Button
+                st.divider()
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    if st.button("✅ Generate Bill", type="primary", use_container_width=True):
+                        if not cust_name:
+                            st.error("Please enter customer name!")
+                        elif len(st.session_state.bill_cart) == 0:
+                            st.error("❌ Cart is empty! Please add items first.")
+                        else:
+                            try:
+                                # Debug info
+                                st.write("DEBUG INFO:")
+                                st.write(f"Customer: {cust_name}")
+                                st.write(f"Cart items: {len(st.session_state.bill_cart)}")
+                                st.write(f"Cash: {cash_paid_adjusted}, Online: {online_paid_adjusted}, Due: {due_amount_adjusted}")
+                                st.write(f"Points: {loyalty_points}")
+                                
+                                bill_key = st.session_state.bill_cart_id
+                                bill_id = make_bill_id(bill_date, bill_key)
+                                
+                                # Collect every row of the bill so it goes out in one request
+                                bill_rows = {"BillHeaders": [], "Bills": [], "LoyaltyPoints": [], "Balances": [], "CustomerKhata": []}
+                                
+                                bill_rows["BillHeaders"].append([
+                                    bill_id,
                                     bill_date.strftime("%d/%m/%Y"),
                                     cust_name,
                                     cust_phone,
-                                    item['Item'],
-                                    item['Qty'],
-                                    item['Rate'],
-                                    item['Amount']
-                                ]
+                                    total_amount,
+                                    discount_amount,
+                                    redeem_value,
+                                    final_amount,
+                                    cash_paid_adjusted,
+                                    online_paid_adjusted,
+                                    due_amount_adjusted,
+                                    loyalty_points,
+                                    st.session_state.username
+                                ])
                                 
-                                if not save_data("Bills", bill_data):
-                                    all_saved = False
-                                    break
+                                for item in st.session_state.bill_cart:
+                                    bill_rows["Bills"].append([
+                                        bill_date.strftime("%d/%m/%Y"),
+                                        cust_name,
+                                        cust_phone,
+                                        item['Item'],
+                                        item['Qty'],
+                                        item['Rate'],
+                                        item['Amount'],
+                                        bill_id
+                                    ])
                                 
-                                # Update stock
-                                if not update_stock_in_sheet(item['Item'], item['Qty'], operation='subtract'):
-                                    st.error(f"Failed to update stock for {item['Item']}")
-                                    all_saved = False
-                                    break
-                            
-                            if all_saved:
                                 # Redeem Points - Save negative entry
                                 if redeem_points > 0:
-                                    redeem_data = [
+                                    bill_rows["LoyaltyPoints"].append([
                                         cust_name,
                                         -redeem_points,  # Negative to deduct
                                         bill_date.strftime("%d/%m/%Y"),
                                         f"Redeemed (₹{redeem_value} discount)",
                                         st.session_state.username
-                                    ]
-                                    save_data("LoyaltyPoints", redeem_data)
+                                    ])
                                 
                                 # Update Cash Balance
                                 if cash_paid > 0:
-                                    update_balance(cash_paid, "Cash", operation='add')
+                                    bill_rows["Balances"].append(balance_row(cash_paid, "Cash", operation='add'))
                                 
                                 # Update Online Balance
                                 if online_paid > 0:
-                                    update_balance(online_paid, "Online", operation='add')
+                                    bill_rows["Balances"].append(balance_row(online_paid, "Online", operation='add'))
                                 
                                 # Save Customer Due if any
                                 if due_amount_adjusted > 0:
-                                    save_data("CustomerKhata", [cust_name, due_amount_adjusted])
+                                    bill_rows["CustomerKhata"].append([cust_name, due_amount_adjusted])
                                 
                                 # Add Loyalty Points (new points earned)
                                 if loyalty_points > 0:
-                                    points_data = [
+                                    bill_rows["LoyaltyPoints"].append([
                                         cust_name,
                                         loyalty_points,
                                         bill_date.strftime("%d/%m/%Y"),
                                         loyalty_reason if loyalty_reason else "Purchase",
                                         st.session_state.username
-                                    ]
-                                    save_data("LoyaltyPoints", points_data)
+                                    ])
                                 
-                                st.success(f"✅ Bill generated successfully!")
-                                if loyalty_points > 0:
-                                    st.info(f"⭐ {loyalty_points} loyalty points added!")
-                                if redeem_points > 0:
-                                    st.success(f"🎁 {redeem_points} points redeemed (₹{redeem_value} discount)!")
-                                st.session_state.bill_cart = []
-                                time.sleep(2)
-                                st.rerun()
-                            else:
-                                st.error("❌ Error generating bill!")
-                        except Exception as e:
-                            st.error(f"❌ Error generating bill: {str(e)}")
+                                stock_changes = [[item['Item'], item['Qty']] for item in st.session_state.bill_cart]
+                                stage_bill(bill_key, cust_name, bill_rows, stock_changes)
+                                
+                                if apply_bill(bill_key):
+                                    # Toasts survive the rerun, so the next customer can be rung up immediately
+                                    st.toast(f"✅ Bill {bill_id} generated successfully!")
+                                    if loyalty_points > 0:
+                                        st.toast(f"⭐ {loyalty_points} loyalty points added!")
+                                    if redeem_points > 0:
+                                        st.toast(f"🎁 {redeem_points} points redeemed (₹{redeem_value} discount)!")
+                                    st.session_state.bill_cart = []
+                                    st.session_state.bill_cart_id = uuid.uuid4().hex
+                                    st.rerun()
+                                else:
+                                    entry = get_journal_bill(bill_key)
+                                    if entry["status"] == "compensated":
+                                        # Nothing of this attempt remains - the next one needs its own keys
+                                        st.session_state.bill_cart_id = uuid.uuid4().hex
+                                        st.error(f"❌ Error generating bill! Nothing was saved ({entry['error']}).")
+                                    else:
+                                        # Redraw the whole page so the bill shows up under Pending Bills
+                                        st.toast("⚠️ Bill could not be completed or undone. "
+                                                 "Resolve it from 'Pending Bills' instead of entering it again.")
+                                        st.rerun()
+                            except Exception as e:
+                                st.error(f"❌ Error generating bill: {str(e)}")
+                
+                with col2:
+                    if st.button("📱 Send WhatsApp Bill", use_container_width=True):
+                        if not cust_phone:
+                            st.error("Please enter customer phone number!")
+                        else:
+                            # Generate bill message
+                            msg = f"*LAIKA PET MART - BILL*\n\n"
+                            msg += f"Customer: {cust_name}\n"
+                            msg += f"Date: {bill_date.strftime('%d/%m/%Y')}\n"
+                            msg += f"{'='*30}\n\n"
+                            
+                            for item in st.session_state.bill_cart:
+                                msg += f"{item['Item']}\n"
+                                msg += f"  Qty: {item['Qty']} × ₹{item['Rate']} = ₹{item['Amount']:.2f}\n\n"
+                            
+                            msg += f"{'='*30}\n"
+                            msg += f"Subtotal: ₹{total_amount:,.2f}\n"
+                            
+                            # Show manual discount if applied
+                            if discount_amount > 0:
+                                msg += f"Discount: -₹{discount_amount:,.2f}"
+                                if discount_reason:
+                                    msg += f" ({discount_reason})"
+                                msg += "\n"
+                            
+                            # Show redeem discount if applied
+                            if redeem_value > 0:
+                                msg += f"Points Discount: -₹{redeem_value:,.2f} ({redeem_points} points)\n"
+                            
+                            # Show final amount if any discount
+                            if discount_amount > 0 or redeem_value > 0:
+                                msg += f"Final Amount: ₹{final_amount:,.2f}\n"
+                            
+                            msg += f"Cash Paid: ₹{cash_paid:,.2f}\n"
+                            msg += f"Online Paid: ₹{online_paid:,.2f}\n"
+                            msg += f"Due: ₹{due_amount_adjusted:,.2f}\n\n"
+                            
+                            msg += f"{'='*30}\n"
+                            msg += f"*LOYALTY POINTS*\n"
+                            msg += f"Previous Balance: {current_customer_points} points\n"
+                            
+                            if loyalty_points > 0:
+                                msg += f"Earned Today: +{loyalty_points} points 🎉\n"
+                            
+                            if redeem_points > 0:
+                                msg += f"Redeemed Today: -{redeem_points} points\n"
+                            
+                            final_points = current_customer_points + loyalty_points - redeem_points
+                            msg += f"*New Balance: {final_points} points* ⭐\n\n"
+                            
+                            msg += f"Thank you for shopping with us! 🐾"
+                            
+                            # Create WhatsApp link
+                            phone = cust_phone.replace("+", "").replace(" ", "")
+                            if not phone.startswith("91"):
+                                phone = "91" + phone
+                            
+                            wa_link = f"https://wa.me/{phone}?text={urllib.parse.quote(msg)}"
+                            st.markdown(f"[📱 Click to Send Bill on WhatsApp]({wa_link})")
             
-            with col2:
-                if st.button("📱 Send WhatsApp Bill", use_container_width=True):
-                    if not cust_phone:
-                        st.error("Please enter customer phone number!")
-                    else:
-                        # Generate bill message
-                        msg = f"*LAIKA PET MART - BILL*\n\n"
-                        msg += f"Customer: {cust_name}\n"
-                        msg += f"Date: {bill_date.strftime('%d/%m/%Y')}\n"
-                        msg += f"{'='*30}\n\n"
-                        
-                        for item in st.session_state.bill_cart:
-                            msg += f"{item['Item']}\n"
-                            msg += f"  Qty: {item['Qty']} × ₹{item['Rate']} = ₹{item['Amount']:.2f}\n\n"
-                        
-                        msg += f"{'='*30}\n"
-                        msg += f"Subtotal: ₹{total_amount:,.2f}\n"
-                        
-                        # Show manual discount if applied
-                        if discount_amount > 0:
-                            msg += f"Discount: -₹{discount_amount:,.2f}"
-                            if discount_reason:
-                                msg += f" ({discount_reason})"
-                            msg += "\n"
-                        
-                        # Show redeem discount if applied
-                        if redeem_value > 0:
-                            msg += f"Points Discount: -₹{redeem_value:,.2f} ({redeem_points} points)\n"
-                        
-                        # Show final amount if any discount
-                        if discount_amount > 0 or redeem_value > 0:
-                            msg += f"Final Amount: ₹{final_amount:,.2f}\n"
-                        
-                        msg += f"Cash Paid: ₹{cash_paid:,.2f}\n"
-                        msg += f"Online Paid: ₹{online_paid:,.2f}\n"
-                        msg += f"Due: ₹{due_amount_adjusted:,.2f}\n\n"
-                        
-                        msg += f"{'='*30}\n"
-                        msg += f"*LOYALTY POINTS*\n"
-                        msg += f"Previous Balance: {current_customer_points} points\n"
-                        
-                        if loyalty_points > 0:
-                            msg += f"Earned Today: +{loyalty_points} points 🎉\n"
-                        
-                        if redeem_points > 0:
-                            msg += f"Redeemed Today: -{redeem_points} points\n"
-                        
-                        final_points = current_customer_points + loyalty_points - redeem_points
-                        msg += f"*New Balance: {final_points} points* ⭐\n\n"
-                        
-                        msg += f"Thank you for shopping with us! 🐾"
-                        
-                        # Create WhatsApp link
-                        phone = cust_phone.replace("+", "").replace(" ", "")
-                        if not phone.startswith("91"):
-                            phone = "91" + phone
-                        
-                        wa_link = f"https://wa.me/{phone}?text={urllib.parse.quote(msg)}"
-                        st.markdown(f"[📱 Click to Send Bill on WhatsApp]({wa_link})")
+        bill_cart_section(cust_name, cust_phone, bill_date)
     
     with tab2:
         st.subheader("📜 Bill History")
         
-        bills_df = load_data("Bills")
-        
-        if not bills_df.empty:
-            # Date filter
-            col1, col2, col3 = st.columns(3)
+        # Paging and opening bills rerun only this section
+        @st.fragment
+        def bill_history_section():
+            """Bills in a date range, one page at a time, with the lines of the selected one"""
+            bill_index = get_bill_index()
+            if bill_index["bills"].empty:
+                st.info("No bills found!")
+                return
             
+            col1, col2, col3 = st.columns([2, 2, 1])
             with col1:
-                filter_date = st.date_input("Filter by Date", value=today_dt, key="filter_bill_date")
-            
+                history_range = st.date_input("Date Range", value=(today_dt - timedelta(days=30), today_dt),
+                                              key="bill_history_range")
             with col2:
-                if st.button("🔍 Filter", key="filter_bills"):
-                    st.rerun()
-            
+                history_customer = st.text_input("Customer", key="bill_history_customer")
             with col3:
-                if st.button("🔄 Show All", key="show_all_bills"):
-                    filter_date = None
-                    st.rerun()
+                st.write("")
+                st.write("")
+                show_all = st.toggle("Show All", key="bill_history_all")
             
-            # Filter bills
-            if filter_date and 'Date' in bills_df.columns:
-                display_df = bills_df[bills_df['Date'] == filter_date]
+            # Date range by binary search over the date-sorted index. The range picker
+            # gives one date while the second is being picked, and none once cleared
+            if not history_range:
+                history_range = (today_dt - timedelta(days=30), today_dt)
+            if show_all:
+                display_bills = bill_index["bills"]
             else:
-                display_df = bills_df
+                display_bills = bills_between(history_range[0], history_range[-1], bill_index)
+            if history_customer:
+                display_bills = display_bills[display_bills.index.isin(bills_for_customer(history_customer, bill_index).index)]
             
-            if not display_df.empty:
-                st.divider()
-                
-                # Group by date and show bills
-                if 'Date' in display_df.columns:
-                    for bill_date in display_df['Date'].unique():
-                        date_bills = display_df[display_df['Date'] == bill_date]
-                        
-                        st.markdown(f"### 📅 {bill_date.strftime('%d/%m/%Y')}")
-                        
-                        # Group by customer for each date
-                        for idx, row in date_bills.iterrows():
-                            with st.expander(f"Bill #{idx+1} - {row.iloc[1] if len(row) > 1 else 'Unknown'} - ₹{row.iloc[6] if len(row) > 6 else 0:.2f}"):
-                                col1, col2 = st.columns(2)
-                                
-                                with col1:
-                                    st.write(f"**Customer:** {row.iloc[1] if len(row) > 1 else 'N/A'}")
-                                    st.write(f"**Phone:** {row.iloc[2] if len(row) > 2 else 'N/A'}")
-                                
-                                with col2:
-                                    st.write(f"**Item:** {row.iloc[3] if len(row) > 3 else 'N/A'}")
-                                    st.write(f"**Qty:** {row.iloc[4] if len(row) > 4 else 0} × ₹{row.iloc[5] if len(row) > 5 else 0} = ₹{row.iloc[6] if len(row) > 6 else 0:.2f}")
-                                
-                                if st.button(f"🗑️ Delete Bill #{idx+1}", key=f"del_history_bill_{idx}"):
-                                    st.warning("Delete functionality coming soon!")
-                        
-                        st.divider()
+            if display_bills.empty:
+                st.info("No bills found for the selected dates!")
+                return
+            
+            # Newest first, a page at a time - only the page's rows are ever rendered
+            col1, col2 = st.columns(2)
+            with col1:
+                page_size = st.selectbox("Bills per page", [25, 50, 100], key="bill_history_page_size")
+            page_count = max(1, -(-len(display_bills) // page_size))
+            with col2:
+                page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1,
+                                       key="bill_history_page")
+            newest_first = display_bills.iloc[::-1]
+            page_bills = newest_first.iloc[(page - 1) * page_size:page * page_size]
+            
+            picked = st.dataframe(
+                page_bills[['Date', 'Customer', 'Phone', 'Lines', 'Final', 'Cash', 'Online', 'Due', 'Cashier']],
+                use_container_width=True,
+                column_config={
+                    "Date": st.column_config.DateColumn(format="DD/MM/YYYY"),
+                    "Lines": st.column_config.NumberColumn("Items"),
+                    "Final": st.column_config.NumberColumn("Amount", format="₹%.2f"),
+                    "Cash": st.column_config.NumberColumn(format="₹%.2f"),
+                    "Online": st.column_config.NumberColumn(format="₹%.2f"),
+                    "Due": st.column_config.NumberColumn(format="₹%.2f"),
+                },
+                on_select="rerun",
+                selection_mode="single-row",
+                key="bill_history_table",
+            )
+            st.caption(f"Showing {len(page_bills)} of {len(display_bills)} bills, totalling ₹{display_bills['Final'].sum():,.2f} - select a row to open it")
+            
+            # Lines are looked up only for the bill that is opened
+            selected_rows = picked.selection.rows
+            if not selected_rows or selected_rows[0] >= len(page_bills):
+                return
+            bill_id = page_bills.index[selected_rows[0]]
+            bill = get_bill(bill_id, bill_index)
+            
+            st.divider()
+            st.markdown(f"### 🧾 Bill {bill_id}")
+            col1, col2 = st.columns(2)
+            
+            with col1:
+                st.write(f"**Customer:** {bill['Customer']}")
+                st.write(f"**Phone:** {bill['Phone']}")
+                st.write(f"**Date:** {bill['Date'].strftime('%d/%m/%Y') if pd.notna(bill['Date']) else '-'}")
+            
+            with col2:
+                if pd.notna(bill['Cashier']):
+                    st.write(f"**Total:** ₹{bill['Total']:.2f} | **Discount:** ₹{bill['Discount']:.2f} | **Points Used:** {bill['Redeemed']:g}")
+                    st.write(f"**Cash:** ₹{bill['Cash']:.2f} | **Online:** ₹{bill['Online']:.2f} | **Due:** ₹{bill['Due']:.2f}")
+                    st.write(f"**Cashier:** {bill['Cashier']}")
                 else:
-                    st.dataframe(display_df, use_container_width=True)
-            else:
-                st.info("No bills found for selected date!")
-        else:
-            st.info("No bills found!")
+                    st.write(f"**Total:** ₹{bill['Total']:.2f}")
+            
+            st.dataframe(bill_lines(bill_id, bill_index)[['Item', 'Qty', 'Rate', 'Amount']],
+                         use_container_width=True, hide_index=True)
+            
+            if st.button(f"🗑️ Delete Bill {bill_id}", key="del_history_bill"):
+                st.warning("Delete functionality coming soon!")
+        
+        bill_history_section()
 
 # ==========================================
 # MENU 3: PURCHASE
@@ -1135,158 +2728,181 @@ elif menu == "📦 Purchase":
         with col2:
             purch_date = st.date_input("📅 Purchase Date", value=today_dt, key="purch_date")
         
-        st.divider()
-        st.subheader("Add Items to Purchase")
-        
-        # Load inventory to show existing items
-        inv_df = load_data("Inventory")
-        existing_items = []
-        if not inv_df.empty:
-            existing_items = sorted(inv_df.iloc[:, 0].unique().tolist())
-        
-        # Option to select existing or add new
-        item_option = st.radio("Item Selection", ["Existing Item", "New Item"], horizontal=True, key="item_option")
-        
-        col1, col2, col3, col4, col5 = st.columns([3, 2, 2, 2, 1])
-        
-        with col1:
-            if item_option == "Existing Item":
-                if existing_items:
-                    selected_item = st.selectbox("Select Existing Item", existing_items, key="purch_existing_item")
-                    item_name = selected_item
+        @st.fragment
+        def purchase_cart_section(supplier_name, supplier_phone, purch_date):
+            """Items and payment of the purchase being entered"""
+            st.divider()
+            st.subheader("Add Items to Purchase")
+            
+            # Load inventory to show existing items
+            existing_items = bool(get_inventory_index())
+            
+            # Option to select existing or add new
+            item_option = st.radio("Item Selection", ["Existing Item", "New Item"], horizontal=True, key="item_option")
+            
+            col1, col2, col3, col4, col5 = st.columns([3, 2, 2, 2, 1])
+            
+            with col1:
+                if item_option == "Existing Item":
+                    if existing_items:
+                        purch_query = st.text_input("🔍 Search Item", placeholder="Name, alias or supplier", key="purch_item_search")
+                        selected_item = st.selectbox("Select Existing Item", search_items(purch_query), key="purch_existing_item")
+                        item_name = selected_item
+                    else:
+                        st.warning("No existing items! Please select 'New Item'")
+                        item_name = ""
                 else:
-                    st.warning("No existing items! Please select 'New Item'")
-                    item_name = ""
-            else:
-                item_name = st.text_input("New Item Name", key="purch_new_item_name").upper()
-        
-        with col2:
-            item_qty = st.number_input("Quantity", min_value=0.0, value=1.0, step=0.5, key="purch_qty")
-        
-        with col3:
-            item_unit = st.selectbox("Unit", ["Kg", "Pcs", "Box", "Bag"], key="purch_unit")
-        
-        with col4:
-            item_rate = st.number_input("Rate/Unit", min_value=0.0, value=0.0, step=1.0, key="purch_rate")
-        
-        with col5:
-            st.write("")
-            st.write("")
-            if st.button("➕", key="add_purch_item"):
+                    item_name = st.text_input("New Item Name", key="purch_new_item_name").upper()
+            
+            with col2:
+                item_qty = st.number_input("Quantity", min_value=0.0, value=1.0, step=0.5, key="purch_qty")
+            
+            with col3:
+                item_unit = st.selectbox("Unit", ["Kg", "Pcs", "Box", "Bag"], key="purch_unit")
+            
+            with col4:
+                item_rate = st.number_input("Rate/Unit", min_value=0.0, value=0.0, step=1.0, key="purch_rate")
+            
+            with col5:
+                st.write("")
+                st.write("")
+                add_clicked = st.button("➕", key="add_purch_item")
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                item_code = st.text_input("🏷️ Barcode / SKU (optional)", key="purch_code")
+            with col2:
+                selling_price = st.number_input("Selling Price (optional)", min_value=0.0, value=0.0, step=1.0, key="purch_selling_price")
+            
+            if add_clicked:
                 if item_name and item_qty > 0 and item_rate > 0:
                     st.session_state.purchase_cart.append({
                         'Item': item_name.upper(),
                         'Qty': item_qty,
                         'Unit': item_unit,
                         'Rate': item_rate,
-                        'Amount': item_qty * item_rate
+                        'Amount': item_qty * item_rate,
+                        'Code': normalize_code(item_code),
+                        'SellingPrice': selling_price
                     })
                     st.success(f"✅ {item_name} added!")
-                    st.rerun()
-        
-        # Display Purchase Cart
-        if st.session_state.purchase_cart:
-            st.divider()
-            st.subheader("🛒 Purchase Cart")
             
-            cart_df = pd.DataFrame(st.session_state.purchase_cart)
-            
-            for idx, row in cart_df.iterrows():
-                col1, col2, col3, col4, col5 = st.columns([3, 2, 2, 2, 1])
-                col1.write(f"**{row['Item']}**")
-                col2.write(f"{row['Qty']} {row['Unit']}")
-                col3.write(f"₹{row['Rate']:.2f}/{row['Unit']}")
-                col4.write(f"₹{row['Amount']:.2f}")
+            # Display Purchase Cart
+            if st.session_state.purchase_cart:
+                st.divider()
+                st.subheader("🛒 Purchase Cart")
                 
-                if col5.button("🗑️", key=f"del_purch_{idx}"):
-                    st.session_state.purchase_cart.pop(idx)
-                    st.rerun()
-            
-            total_amount = cart_df['Amount'].sum()
-            
-            st.markdown(f"""
-            <div style="background: linear-gradient(135deg, #4facfe 0%, #00f2fe 100%); padding: 20px; border-radius: 12px; text-align: center; color: white; margin: 20px 0;">
-                <h2 style="margin: 0;">Total Purchase: ₹{total_amount:,.2f}</h2>
-            </div>
-            """, unsafe_allow_html=True)
-            
-            # Payment Details
-            st.divider()
-            st.subheader("💳 Payment Mode")
-            
-            payment_mode = st.radio("Select Payment Mode", 
-                                    ["💵 Cash", "🏦 Online", "👋 Hand Investment", "📒 Credit (Supplier Due)"],
-                                    horizontal=True,
-                                    key="purch_payment_mode")
-            
-            if payment_mode == "📒 Credit (Supplier Due)":
-                paid_amount = st.number_input("Paid Amount (if any)", min_value=0.0, value=0.0, step=10.0, key="purch_paid")
-                due_amount = total_amount - paid_amount
+                cart_df = pd.DataFrame(st.session_state.purchase_cart)
                 
-                if paid_amount > 0:
-                    paid_mode = st.radio("Paid via", ["💵 Cash", "🏦 Online"], horizontal=True, key="purch_paid_mode")
-            
-            # Save Purchase Button
-            st.divider()
-            
-            if st.button("✅ Save Purchase", type="primary", use_container_width=True):
-                if not supplier_name:
-                    st.error("Please enter supplier name!")
-                else:
-                    all_saved = True
+                for idx, row in cart_df.iterrows():
+                    col1, col2, col3, col4, col5 = st.columns([3, 2, 2, 2, 1])
+                    col1.write(f"**{row['Item']}**")
+                    col2.write(f"{row['Qty']} {row['Unit']}")
+                    col3.write(f"₹{row['Rate']:.2f}/{row['Unit']}")
+                    col4.write(f"₹{row['Amount']:.2f}")
                     
-                    for item in st.session_state.purchase_cart:
-                        # Save to Purchases sheet
-                        purch_data = [
-                            purch_date.strftime("%d/%m/%Y"),
-                            supplier_name,
-                            supplier_phone,
-                            item['Item'],
-                            f"{item['Qty']} {item['Unit']}",
-                            item['Amount']
-                        ]
-                        
-                        if not save_data("Purchases", purch_data):
-                            all_saved = False
-                            break
+                    col5.button("🗑️", key=f"del_purch_{idx}", on_click=st.session_state.purchase_cart.pop, args=(idx,))
+                
+                total_amount = cart_df['Amount'].sum()
+                
+                st.markdown(f"""
+                <div style="background: linear-gradient(135deg, #4facfe 0%, #00f2fe 100%); padding: 20px; border-radius: 12px; text-align: center; color: white; margin: 20px 0;">
+                    <h2 style="margin: 0;">Total Purchase: ₹{total_amount:,.2f}</h2>
+                </div>
+                """, unsafe_allow_html=True)
+                
+                # Payment Details
+                st.divider()
+                st.subheader("💳 Payment Mode")
+                
+                payment_mode = st.radio("Select Payment Mode", 
+                                        ["💵 Cash", "🏦 Online", "👋 Hand Investment", "📒 Credit (Supplier Due)"],
+                                        horizontal=True,
+                                        key="purch_payment_mode")
+                
+                if payment_mode == "📒 Credit (Supplier Due)":
+                    paid_amount = st.number_input("Paid Amount (if any)", min_value=0.0, value=0.0, step=10.0, key="purch_paid")
+                    due_amount = total_amount - paid_amount
+                    
+                    if paid_amount > 0:
+                        paid_mode = st.radio("Paid via", ["💵 Cash", "🏦 Online"], horizontal=True, key="purch_paid_mode")
+                
+                # Save Purchase Button
+                st.divider()
+                
+                if st.button("✅ Save Purchase", type="primary", use_container_width=True):
+                    if not supplier_name:
+                        st.error("Please enter supplier name!")
+                    else:
+                        purchase_rows = {"Purchases": [], "Inventory": [], "StockLedger": [], "ItemCodes": [],
+                                         "Balances": [], "HandInvestments": [], "SupplierDues": []}
+                        code_index = get_sheet_index("ItemCodes", build_item_code_index)
                         
-                        # Save to Inventory
-                        inv_data = [
-                            item['Item'],
-                            item['Qty'],
-                            item['Unit'],
-                            item['Rate'],
-                            purch_date.strftime("%d/%m/%Y")
-                        ]
+                        for item in st.session_state.purchase_cart:
+                            # Save to Purchases sheet
+                            purchase_rows["Purchases"].append([
+                                purch_date.strftime("%d/%m/%Y"),
+                                supplier_name,
+                                supplier_phone,
+                                item['Item'],
+                                f"{item['Qty']} {item['Unit']}",
+                                item['Amount']
+                            ])
+                            
+                            # Save to Inventory
+                            purchase_rows["Inventory"].append([
+                                item['Item'],
+                                item['Qty'],
+                                item['Unit'],
+                                item['Rate'],
+                                purch_date.strftime("%d/%m/%Y")
+                            ])
+                            
+                            # Stock movement
+                            purchase_rows["StockLedger"].append([
+                                purch_date.strftime("%d/%m/%Y"),
+                                item['Item'],
+                                item['Qty'],
+                                "purchase",
+                                supplier_name,
+                                st.session_state.username
+                            ])
+                            
+                            # New or re-pointed barcode
+                            if item.get('Code'):
+                                known = code_index.get(item['Code'])
+                                price = item['SellingPrice'] or (known["price"] if known else 0)
+                                if known != {"item": item['Item'], "price": price}:
+                                    purchase_rows["ItemCodes"].append([item['Code'], item['Item'], price])
                         
-                        if not save_data("Inventory", inv_data):
-                            all_saved = False
-                            break
-                    
-                    if all_saved:
                         # Update balances based on payment mode
                         if payment_mode == "💵 Cash":
-                            update_balance(total_amount, "Cash", operation='subtract')
+                            purchase_rows["Balances"].append(balance_row(total_amount, "Cash", operation='subtract'))
                         elif payment_mode == "🏦 Online":
-                            update_balance(total_amount, "Online", operation='subtract')
+                            purchase_rows["Balances"].append(balance_row(total_amount, "Online", operation='subtract'))
                         elif payment_mode == "👋 Hand Investment":
-                            save_data("HandInvestments", [supplier_name, purch_date.strftime("%d/%m/%Y"), total_amount])
+                            purchase_rows["HandInvestments"].append([supplier_name, purch_date.strftime("%d/%m/%Y"), total_amount])
                         elif payment_mode == "📒 Credit (Supplier Due)":
                             if paid_amount > 0:
                                 if paid_mode == "💵 Cash":
-                                    update_balance(paid_amount, "Cash", operation='subtract')
+                                    purchase_rows["Balances"].append(balance_row(paid_amount, "Cash", operation='subtract'))
                                 else:
-                                    update_balance(paid_amount, "Online", operation='subtract')
+                                    purchase_rows["Balances"].append(balance_row(paid_amount, "Online", operation='subtract'))
                             
                             if due_amount > 0:
-                                save_data("SupplierDues", [supplier_name, due_amount, purch_date.strftime("%d/%m/%Y")])
+                                purchase_rows["SupplierDues"].append([supplier_name, due_amount, purch_date.strftime("%d/%m/%Y")])
                         
-                        st.success("✅ Purchase saved successfully!")
-                        st.session_state.purchase_cart = []
-                        time.sleep(1)
-                        st.rerun()
-                    else:
-                        st.error("❌ Error saving purchase!")
+                        if save_batch(purchase_rows):
+                            for row in purchase_rows["Balances"]:
+                                remember_balance(row)
+                            
+                            st.toast("✅ Purchase saved successfully!")
+                            st.session_state.purchase_cart = []
+                            st.rerun()
+                        else:
+                            st.error("❌ Error saving purchase!")
+            
+        purchase_cart_section(supplier_name, supplier_phone, purch_date)
     
     with tab2:
         st.subheader("📜 Purchase History")
@@ -1303,50 +2919,90 @@ elif menu == "📦 Purchase":
 # ==========================================
 elif menu == "📋 Live Stock":
     st.header("📋 Live Stock")
-    i_df = load_data("Inventory")
+    stock_table = current_stock_table()
     
-    if not i_df.empty and len(i_df.columns) > 4:
-        latest_stock = i_df.groupby(i_df.columns[0]).tail(1).copy()
-        
-        latest_stock['qty_v'] = pd.to_numeric(latest_stock.iloc[:, 1], errors='coerce').fillna(0)
-        latest_stock['rate_v'] = pd.to_numeric(latest_stock.iloc[:, 3], errors='coerce').fillna(0)
-        latest_stock['value'] = latest_stock['qty_v'] * latest_stock['rate_v']
-        t_v = latest_stock['value'].sum()
+    if not stock_table.empty:
+        t_v = stock_table['Value'].sum()
         
         st.subheader(f"💰 Total Stock Value: ₹{t_v:,.2f}")
+        st.caption(f"FIFO: ₹{stock_table['FIFO Value'].sum():,.2f} | Weighted average: ₹{stock_table['Avg Value'].sum():,.2f}")
+        
+        with st.expander("✏️ Adjust Stock"):
+            col1, col2, col3 = st.columns([3, 2, 3])
+            adjust_item = col1.selectbox("Item", stock_table['Item'].tolist(), key="adjust_item")
+            adjust_qty = col2.number_input("Change (+/-)", value=0.0, step=0.5, key="adjust_qty")
+            adjust_reason = col3.text_input("Reason", placeholder="e.g., Damaged, Stock count", key="adjust_reason")
+            if st.button("💾 Save Adjustment", key="save_adjustment"):
+                if adjust_qty == 0 or not adjust_reason:
+                    st.error("Please enter a change and a reason!")
+                else:
+                    try:
+                        adjusted = apply_stock_deltas({normalize_item(adjust_item): adjust_qty}, "adjustment", adjust_reason)
+                    except Exception as e:
+                        adjusted = False
+                        st.error(f"Stock update error: {str(e)}")
+                    if adjusted:
+                        st.toast("✅ Stock adjusted!")
+                        st.rerun()
         
-        stock_summary = latest_stock[[latest_stock.columns[0], latest_stock.columns[1], latest_stock.columns[2], latest_stock.columns[3], 'qty_v', 'value']].copy()
-        stock_summary.columns = ['Item', 'Qty_Num', 'Unit', 'Rate', 'Qty_Numeric', 'Value']
-        stock_summary['Quantity'] = stock_summary['Qty_Num'].astype(str) + ' ' + stock_summary['Unit'].astype(str)
-        
-        low_stock_items = []
-        normal_stock_items = []
+        stock_summary = reorder_table(stock_table, today_dt)
         
-        for _, row in stock_summary.iterrows():
-            item_dict = {
-                'Item': row['Item'],
-                'Quantity': row['Quantity'],
-                'Rate': f"₹{row['Rate']:.2f}",
-                'Stock Value': f"₹{row['Value']:.2f}",
-                'Qty_Numeric': row['Qty_Numeric']
-            }
-            
-            if row['Qty_Numeric'] < 2:
-                low_stock_items.append(item_dict)
-            else:
-                normal_stock_items.append(item_dict)
+        # One summary line instead of a widget per item
+        alert_count = stock_summary['Status'].isin(['out', 'reorder']).sum()
+        if alert_count:
+            st.error(f"🚨 **{alert_count} items need reordering** - filter by status below to see them")
         
-        if low_stock_items:
-            st.divider()
-            st.subheader("🚨 LOW STOCK ALERT")
-            for item in low_stock_items:
-                st.error(f"🚨 **{item['Item']}** - {item['Quantity']} - Rate: {item['Rate']} - Value: {item['Stock Value']}")
+        st.divider()
         
-        if normal_stock_items:
-            st.divider()
-            st.subheader("✅ Available Stock")
-            for item in normal_stock_items:
-                st.info(f"✅ **{item['Item']}** - {item['Quantity']} - Rate: {item['Rate']} - Value: {item['Stock Value']}")
+        # Filters, sorting and paging all run here; only one page goes to the browser
+        col1, col2, col3, col4 = st.columns([3, 2, 2, 2])
+        with col1:
+            stock_search = st.text_input("🔍 Search Item", key="stock_search")
+        with col2:
+            status_filter = st.multiselect("Status", ["out", "reorder", "overstock", "ok"], key="stock_status")
+        with col3:
+            unit_filter = st.multiselect("Category (Unit)", sorted(stock_summary['Unit'].dropna().astype(str).unique()), key="stock_unit")
+        with col4:
+            min_value = st.number_input("Min Value (₹)", min_value=0.0, value=0.0, step=100.0, key="stock_min_value")
+        
+        view = stock_summary
+        if stock_search:
+            view = view[view['Item'].astype(str).str.contains(stock_search, case=False, regex=False)]
+        if status_filter:
+            view = view[view['Status'].isin(status_filter)]
+        if unit_filter:
+            view = view[view['Unit'].astype(str).isin(unit_filter)]
+        if min_value > 0:
+            view = view[view['Value'] >= min_value]
+        
+        col1, col2, col3, col4 = st.columns([3, 2, 2, 2])
+        with col1:
+            sort_by = st.selectbox("Sort By", ["Days Cover", "Item", "Qty", "Value", "Velocity"], key="stock_sort")
+        with col2:
+            sort_desc = st.toggle("Descending", value=sort_by in ("Value", "Velocity"), key="stock_sort_desc")
+        with col3:
+            page_size = st.selectbox("Rows per page", [25, 50, 100], key="stock_page_size")
+        page_count = max(1, -(-len(view) // page_size))
+        with col4:
+            page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1, key="stock_page")
+        
+        view = view.sort_values(sort_by, ascending=not sort_desc, kind='mergesort')
+        page_rows = view.iloc[(page - 1) * page_size:page * page_size]
+        
+        st.dataframe(
+            page_rows[['Item', 'Qty', 'Unit', 'Status', 'Days Cover', 'Velocity', 'Order Qty', 'Rate', 'Value']],
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "Qty": st.column_config.NumberColumn(format="%g"),
+                "Days Cover": st.column_config.NumberColumn("Days Left", format="%.0f"),
+                "Velocity": st.column_config.NumberColumn("Sold/Day", format="%.2f"),
+                "Order Qty": st.column_config.NumberColumn("Suggested Order", format="%g"),
+                "Rate": st.column_config.NumberColumn("Unit Cost", format="₹%.2f"),
+                "Value": st.column_config.NumberColumn(format="₹%.2f"),
+            },
+        )
+        st.caption(f"Showing {len(page_rows)} of {len(view)} items")
 
 # ==========================================
 # MENU 5: CUSTOMER DUE
@@ -1356,12 +3012,8 @@ elif menu == "📒 Customer Due":
     
     k_df = load_data("CustomerKhata")
     
-    if not k_df.empty and len(k_df.columns) >= 2:
-        # Convert amount column to numeric
-        k_df_copy = k_df.copy()
-        k_df_copy.iloc[:, 1] = pd.to_numeric(k_df_copy.iloc[:, 1], errors='coerce').fillna(0)
-        
-        customer_dues = k_df_copy.groupby(k_df_copy.columns[0])[k_df_copy.columns[1]].sum()
+    if not k_df.empty:
+        customer_dues = k_df.groupby('Customer')['Amount'].sum()
         customers_with_due = customer_dues[customer_dues > 0]
         
         if not customers_with_due.empty:
@@ -1432,12 +3084,8 @@ elif menu == "🏢 Supplier Dues":
     
     sup_df = load_data("SupplierDues")
     
-    if not sup_df.empty and len(sup_df.columns) >= 2:
-        # Convert amount column to numeric
-        sup_df_copy = sup_df.copy()
-        sup_df_copy.iloc[:, 1] = pd.to_numeric(sup_df_copy.iloc[:, 1], errors='coerce').fillna(0)
-        
-        supplier_dues = sup_df_copy.groupby(sup_df_copy.columns[0])[sup_df_copy.columns[1]].sum()
+    if not sup_df.empty:
+        supplier_dues = sup_df.groupby('Supplier')['Amount'].sum()
         suppliers_with_due = supplier_dues[supplier_dues > 0]
         
         if not suppliers_with_due.empty:
@@ -1625,21 +3273,17 @@ elif menu == "💰 Expenses":
         
         if not exp_df.empty:
             # Monthly summary
-            if 'Date' in exp_df.columns and len(exp_df.columns) > 2:
-                current_month = today_dt.month
-                current_year = today_dt.year
-                
-                month_expenses = exp_df[(exp_df['Date'].apply(lambda x: x.month if pd.notna(x) else 0) == current_month) & 
-                                       (exp_df['Date'].apply(lambda x: x.year if pd.notna(x) else 0) == current_year)]
+            month_start = today_dt.replace(day=1)
+            month_expenses = exp_df[(exp_df['Date'] >= month_start) & (exp_df['Date'] <= today_dt)]
                 
-                if not month_expenses.empty:
-                    total_month_exp = pd.to_numeric(month_expenses.iloc[:, 2], errors='coerce').sum()
+            if not month_expenses.empty:
+                total_month_exp = month_expenses['Amount'].sum()
                     
-                    st.markdown(f"""
-                    <div style="background: linear-gradient(135deg, #ff9966 0%, #ff5e62 100%); padding: 20px; border-radius: 12px; text-align: center; color: white; margin-bottom: 20px;">
-                        <h2 style="margin: 0;">This Month's Expenses: ₹{total_month_exp:,.2f}</h2>
-                    </div>
-                    """, unsafe_allow_html=True)
+                st.markdown(f"""
+                <div style="background: linear-gradient(135deg, #ff9966 0%, #ff5e62 100%); padding: 20px; border-radius: 12px; text-align: center; color: white; margin-bottom: 20px;">
+                    <h2 style="margin: 0;">This Month's Expenses: ₹{total_month_exp:,.2f}</h2>
+                </div>
+                """, unsafe_allow_html=True)
             
             st.divider()
             st.dataframe(exp_df, use_container_width=True)
@@ -1744,14 +3388,13 @@ elif menu == "💉 Services":
                     st.rerun()
             
             # Calculate total
-            if len(services_df.columns) > 6:
-                total_services = pd.to_numeric(services_df.iloc[:, 6], errors='coerce').sum()
+            total_services = services_df['Amount'].sum()
                 
-                st.markdown(f"""
-                <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 20px; border-radius: 12px; text-align: center; color: white; margin: 20px 0;">
-                    <h2 style="margin: 0;">Total Service Income: ₹{total_services:,.2f}</h2>
-                </div>
-                """, unsafe_allow_html=True)
+            st.markdown(f"""
+            <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 20px; border-radius: 12px; text-align: center; color: white; margin: 20px 0;">
+                <h2 style="margin: 0;">Total Service Income: ₹{total_services:,.2f}</h2>
+            </div>
+            """, unsafe_allow_html=True)
             
             st.divider()
             
@@ -1762,23 +3405,23 @@ elif menu == "💉 Services":
             
             if not display_df.empty:
                 for idx, row in display_df.iterrows():
-                    with st.expander(f"🐾 {row.iloc[1] if len(row) > 1 else 'Customer'} - {row.iloc[5] if len(row) > 5 else 'Service'} - ₹{row.iloc[6] if len(row) > 6 else 0:.2f}"):
+                    with st.expander(f"🐾 {row['Customer']} - {row['Service']} - ₹{row['Amount']:.2f}"):
                         col1, col2 = st.columns(2)
                         
                         with col1:
-                            st.write(f"**Date:** {row.iloc[0] if len(row) > 0 else 'N/A'}")
-                            st.write(f"**Customer:** {row.iloc[1] if len(row) > 1 else 'N/A'}")
-                            st.write(f"**Phone:** {row.iloc[2] if len(row) > 2 else 'N/A'}")
-                            st.write(f"**Pet Name:** {row.iloc[3] if len(row) > 3 else 'N/A'}")
+                            st.write(f"**Date:** {row['Date']}")
+                            st.write(f"**Customer:** {row['Customer']}")
+                            st.write(f"**Phone:** {row['Phone']}")
+                            st.write(f"**Pet Name:** {row['PetName']}")
                         
                         with col2:
-                            st.write(f"**Pet Type:** {row.iloc[4] if len(row) > 4 else 'N/A'}")
-                            st.write(f"**Service:** {row.iloc[5] if len(row) > 5 else 'N/A'}")
-                            st.write(f"**Amount:** ₹{row.iloc[6] if len(row) > 6 else 0:.2f}")
-                            st.write(f"**Payment:** {row.iloc[7] if len(row) > 7 else 'N/A'}")
+                            st.write(f"**Pet Type:** {row['PetType']}")
+                            st.write(f"**Service:** {row['Service']}")
+                            st.write(f"**Amount:** ₹{row['Amount']:.2f}")
+                            st.write(f"**Payment:** {row['Payment']}")
                         
-                        if len(row) > 8 and row.iloc[8]:
-                            st.write(f"**Notes:** {row.iloc[8]}")
+                        if pd.notna(row['Notes']) and row['Notes']:
+                            st.write(f"**Notes:** {row['Notes']}")
             else:
                 st.info("No services found for selected date!")
         else:
@@ -1899,8 +3542,8 @@ elif menu == "🎁 Offers & Discount":
             
             # Display offers
             for idx, row in offers_df.iterrows():
-                if len(row) >= 6:
-                    offer_status = row.iloc[5] if len(row) > 5 else "Active"
+                if pd.notna(row['Status']):
+                    offer_status = row['Status']
                     
                     if filter_status == "All" or filter_status == offer_status:
                         status_color = "linear-gradient(135deg, #43e97b 0%, #38f9d7 100%)" if offer_status == "Active" else "linear-gradient(135deg, #ff9966 0%, #ff5e62 100%)"
@@ -1910,9 +3553,9 @@ elif menu == "🎁 Offers & Discount":
                             <div style="background: {status_color}; padding: 20px; border-radius: 12px; color: white; margin-bottom: 15px; box-shadow: 0 4px 15px rgba(0,0,0,0.2);">
                                 <div style="display: flex; justify-content: space-between; align-items: center;">
                                     <div style="flex: 1;">
-                                        <h3 style="margin: 0 0 10px 0;">🎁 {row.iloc[0]}</h3>
-                                        <p style="margin: 0; font-size: 16px;">{row.iloc[2]}</p>
-                                        <p style="margin: 10px 0 0 0; font-size: 14px; opacity: 0.9;">📅 Valid: {row.iloc[3]} - {row.iloc[4]}</p>
+                                        <h3 style="margin: 0 0 10px 0;">🎁 {row['Name']}</h3>
+                                        <p style="margin: 0; font-size: 16px;">{row['Description']}</p>
+                                        <p style="margin: 10px 0 0 0; font-size: 14px; opacity: 0.9;">📅 Valid: {row['ValidFrom']} - {row['ValidTill']}</p>
                                     </div>
                                     <div style="text-align: right;">
                                         <span style="background: rgba(255,255,255,0.3); padding: 8px 16px; border-radius: 20px; font-weight: bold;">
@@ -2031,13 +3674,13 @@ elif menu == "⭐ Loyalty Points":
                 
                 loyalty_df = load_data("LoyaltyPoints")
                 if not loyalty_df.empty:
-                    customer_history = loyalty_df[loyalty_df.iloc[:, 0].str.strip().str.upper() == customer_name.strip().upper()]
+                    customer_history = loyalty_df[loyalty_df['Customer'].str.strip().str.upper() == customer_name.strip().upper()]
                     
                     if not customer_history.empty:
                         for idx, row in customer_history.iterrows():
-                            points_val = int(pd.to_numeric(row.iloc[1], errors='coerce'))
-                            date_val = row.iloc[2] if len(row) > 2 else "N/A"
-                            reason_val = row.iloc[3] if len(row) > 3 else "N/A"
+                            points_val = int(row['Points']) if pd.notna(row['Points']) else 0
+                            date_val = row['Date'] if pd.notna(row['Date']) else "N/A"
+                            reason_val = row['Reason'] if pd.notna(row['Reason']) else "N/A"
                             
                             st.info(f"**{date_val}**: +{points_val} points - {reason_val}")
                     else:
@@ -2050,8 +3693,8 @@ elif menu == "⭐ Loyalty Points":
         
         loyalty_df = load_data("LoyaltyPoints")
         
-        if not loyalty_df.empty and len(loyalty_df.columns) > 1:
-            customer_points = loyalty_df.groupby(loyalty_df.columns[0])[loyalty_df.columns[1]].sum()
+        if not loyalty_df.empty:
+            customer_points = loyalty_df.groupby('Customer')['Points'].sum()
             customer_points = customer_points.sort_values(ascending=False)
             
             st.markdown("""
@@ -2106,32 +3749,14 @@ elif menu == "📈 Analysis Report":
     st.divider()
     
     # Load all data
-    bills_df = load_data("Bills")
-    purchase_df = load_data("Purchases")
-    expense_df = load_data("Expenses")
-    customer_df = load_data("CustomerKhata")
-    supplier_df = load_data("SupplierDues")
-    inv_df = load_data("Inventory")
+    report_sheets = load_many(["CustomerKhata", "SupplierDues", "Inventory", "Balances", "StockLedger", "StockSnapshots"])
+    customer_df = report_sheets["CustomerKhata"]
+    supplier_df = report_sheets["SupplierDues"]
     
     # Calculate metrics for selected period
-    period_sales = 0
-    period_purchase = 0
-    period_expense = 0
-    
-    if not bills_df.empty and 'Date' in bills_df.columns:
-        period_bills = bills_df[(bills_df['Date'] >= analysis_from) & (bills_df['Date'] <= analysis_to)]
-        if len(period_bills.columns) > 6:
-            period_sales = pd.to_numeric(period_bills.iloc[:, 6], errors='coerce').sum()
-    
-    if not purchase_df.empty and 'Date' in purchase_df.columns:
-        period_purchases = purchase_df[(purchase_df['Date'] >= analysis_from) & (purchase_df['Date'] <= analysis_to)]
-        if len(period_purchases.columns) > 5:
-            period_purchase = pd.to_numeric(period_purchases.iloc[:, 5], errors='coerce').sum()
-    
-    if not expense_df.empty and 'Date' in expense_df.columns:
-        period_expenses = expense_df[(expense_df['Date'] >= analysis_from) & (expense_df['Date'] <= analysis_to)]
-        if len(period_expenses.columns) > 2:
-            period_expense = pd.to_numeric(period_expenses.iloc[:, 2], errors='coerce').sum()
+    period_sales = sheet_total("Bills", "Amount", analysis_from, analysis_to)
+    period_purchase = sheet_total("Purchases", "Amount", analysis_from, analysis_to)
+    period_expense = sheet_total("Expenses", "Amount", analysis_from, analysis_to)
     
     period_profit = period_sales - period_purchase - period_expense
     
@@ -2168,28 +3793,18 @@ elif menu == "📈 Analysis Report":
     
     # Customer Dues
     total_customer_due = 0
-    if not customer_df.empty and len(customer_df.columns) >= 2:
-        customer_df_copy = customer_df.copy()
-        customer_df_copy.iloc[:, 1] = pd.to_numeric(customer_df_copy.iloc[:, 1], errors='coerce').fillna(0)
-        customer_dues = customer_df_copy.groupby(customer_df_copy.columns[0])[customer_df_copy.columns[1]].sum()
+    if not customer_df.empty:
+        customer_dues = customer_df.groupby('Customer')['Amount'].sum()
         total_customer_due = customer_dues[customer_dues > 0].sum()
     
     # Supplier Dues
     total_supplier_due = 0
-    if not supplier_df.empty and len(supplier_df.columns) >= 2:
-        supplier_df_copy = supplier_df.copy()
-        supplier_df_copy.iloc[:, 1] = pd.to_numeric(supplier_df_copy.iloc[:, 1], errors='coerce').fillna(0)
-        supplier_dues = supplier_df_copy.groupby(supplier_df_copy.columns[0])[supplier_df_copy.columns[1]].sum()
+    if not supplier_df.empty:
+        supplier_dues = supplier_df.groupby('Supplier')['Amount'].sum()
         total_supplier_due = supplier_dues[supplier_dues > 0].sum()
     
     # Stock Value
-    total_stock_value = 0
-    if not inv_df.empty and len(inv_df.columns) > 3:
-        latest_stock = inv_df.groupby(inv_df.iloc[:, 0]).tail(1)
-        latest_stock['qty_val'] = pd.to_numeric(latest_stock.iloc[:, 1], errors='coerce').fillna(0)
-        latest_stock['rate_val'] = pd.to_numeric(latest_stock.iloc[:, 3], errors='coerce').fillna(0)
-        latest_stock['total_val'] = latest_stock['qty_val'] * latest_stock['rate_val']
-        total_stock_value = latest_stock['total_val'].sum()
+    total_stock_value = current_stock_table()['Value'].sum()
     
     col1, col2, col3 = st.columns(3)
     
@@ -2273,35 +3888,27 @@ elif menu == "📈 Analysis Report":
     
     with col1:
         st.markdown("#### 👥 Top Customers")
-        if not bills_df.empty and 'Date' in bills_df.columns:
-            period_bills = bills_df[(bills_df['Date'] >= analysis_from) & (bills_df['Date'] <= analysis_to)]
-            if not period_bills.empty and len(period_bills.columns) > 6:
-                customer_sales = period_bills.groupby(period_bills.columns[1])[period_bills.columns[6]].apply(lambda x: pd.to_numeric(x, errors='coerce').sum())
-                top_customers = customer_sales.nlargest(5)
-                
-                for idx, (customer, amount) in enumerate(top_customers.items(), 1):
-                    medal = "🥇" if idx == 1 else "🥈" if idx == 2 else "🥉" if idx == 3 else "⭐"
-                    st.success(f"{medal} **{customer}**: ₹{amount:,.2f}")
-            else:
-                st.info("No customer data for this period")
+        customer_sales = sheet_totals_by("Bills", "Amount", "Customer", analysis_from, analysis_to)
+        if not customer_sales.empty:
+            top_customers = customer_sales.nlargest(5)
+            
+            for idx, (customer, amount) in enumerate(top_customers.items(), 1):
+                medal = "🥇" if idx == 1 else "🥈" if idx == 2 else "🥉" if idx == 3 else "⭐"
+                st.success(f"{medal} **{customer}**: ₹{amount:,.2f}")
         else:
-            st.info("No customer data available")
+            st.info("No customer data for this period")
     
     with col2:
         st.markdown("#### 🛍️ Top Selling Products")
-        if not bills_df.empty and 'Date' in bills_df.columns:
-            period_bills = bills_df[(bills_df['Date'] >= analysis_from) & (bills_df['Date'] <= analysis_to)]
-            if not period_bills.empty and len(period_bills.columns) > 6:
-                product_sales = period_bills.groupby(period_bills.columns[3])[period_bills.columns[6]].apply(lambda x: pd.to_numeric(x, errors='coerce').sum())
-                top_products = product_sales.nlargest(5)
-                
-                for idx, (product, amount) in enumerate(top_products.items(), 1):
-                    medal = "🥇" if idx == 1 else "🥈" if idx == 2 else "🥉" if idx == 3 else "⭐"
-                    st.success(f"{medal} **{product}**: ₹{amount:,.2f}")
-            else:
-                st.info("No product data for this period")
+        product_sales = sheet_totals_by("Bills", "Amount", "Item", analysis_from, analysis_to)
+        if not product_sales.empty:
+            top_products = product_sales.nlargest(5)
+            
+            for idx, (product, amount) in enumerate(top_products.items(), 1):
+                medal = "🥇" if idx == 1 else "🥈" if idx == 2 else "🥉" if idx == 3 else "⭐"
+                st.success(f"{medal} **{product}**: ₹{amount:,.2f}")
         else:
-            st.info("No product data available")
+            st.info("No product data for this period")
 
 
 # ==========================================
@@ -2329,13 +3936,9 @@ elif menu == "📑 Financial Reports":
     st.divider()
     
     # Load Data
-    bills_df = load_data("Bills")
-    purchase_df = load_data("Purchases")
-    expense_df = load_data("Expenses")
-    services_df = load_data("Services")
-    customer_df = load_data("CustomerKhata")
-    supplier_df = load_data("SupplierDues")
-    inv_df = load_data("Inventory")
+    report_sheets = load_many(["CustomerKhata", "SupplierDues", "Inventory", "Balances", "StockLedger", "StockSnapshots"])
+    customer_df = report_sheets["CustomerKhata"]
+    supplier_df = report_sheets["SupplierDues"]
     
     # ==========================================
     # PROFIT & LOSS
@@ -2346,17 +3949,8 @@ elif menu == "📑 Financial Reports":
         st.divider()
         
         # Calculate Income
-        sales_income = 0
-        if not bills_df.empty and 'Date' in bills_df.columns:
-            period_bills = bills_df[(bills_df['Date'] >= fin_from) & (bills_df['Date'] <= fin_to)]
-            if len(period_bills.columns) > 6:
-                sales_income = pd.to_numeric(period_bills.iloc[:, 6], errors='coerce').sum()
-        
-        service_income = 0
-        if not services_df.empty and 'Date' in services_df.columns:
-            period_services = services_df[(services_df['Date'] >= fin_from) & (services_df['Date'] <= fin_to)]
-            if len(period_services.columns) > 6:
-                service_income = pd.to_numeric(period_services.iloc[:, 6], errors='coerce').sum()
+        sales_income = sheet_total("Bills", "Amount", fin_from, fin_to)
+        service_income = sheet_total("Services", "Amount", fin_from, fin_to)
         
         total_income = sales_income + service_income
         
@@ -2384,18 +3978,16 @@ elif menu == "📑 Financial Reports":
         st.divider()
         
         # Calculate COGS
-        cogs = 0
-        if not purchase_df.empty and 'Date' in purchase_df.columns:
-            period_purchases = purchase_df[(purchase_df['Date'] >= fin_from) & (purchase_df['Date'] <= fin_to)]
-            if len(period_purchases.columns) > 5:
-                cogs = pd.to_numeric(period_purchases.iloc[:, 5], errors='coerce').sum()
+        cost_method = st.radio("Costing Method", ["FIFO", "Weighted Average"], horizontal=True, key="pl_cost_method")
+        cogs = period_cogs(fin_from, fin_to, "fifo" if cost_method == "FIFO" else "average")
         
         st.markdown("### 📦 COST OF GOODS SOLD")
         col1, col2 = st.columns([3, 1])
         with col1:
-            st.write("Purchases")
+            st.write(f"Cost of Items Sold ({cost_method})")
         with col2:
             st.write(f"₹{cogs:,.2f}")
+        st.caption(f"Purchases in period: ₹{sheet_total('Purchases', 'Amount', fin_from, fin_to):,.2f}")
         
         gross_profit = total_income - cogs
         
@@ -2412,20 +4004,15 @@ elif menu == "📑 Financial Reports":
         st.markdown("### 💸 OPERATING EXPENSES")
         
         total_expenses = 0
-        if not expense_df.empty and 'Date' in expense_df.columns:
-            period_expenses = expense_df[(expense_df['Date'] >= fin_from) & (expense_df['Date'] <= fin_to)]
-            if len(period_expenses.columns) > 2:
-                expense_by_cat = period_expenses.groupby(period_expenses.columns[1])[period_expenses.columns[2]].apply(
-                    lambda x: pd.to_numeric(x, errors='coerce').sum()
-                )
-                
-                for category, amount in expense_by_cat.items():
-                    col1, col2 = st.columns([3, 1])
-                    with col1:
-                        st.write(f"{category}")
-                    with col2:
-                        st.write(f"₹{amount:,.2f}")
-                    total_expenses += amount
+        expense_by_cat = sheet_totals_by("Expenses", "Amount", "Category", fin_from, fin_to)
+        
+        for category, amount in expense_by_cat.items():
+            col1, col2 = st.columns([3, 1])
+            with col1:
+                st.write(f"{category}")
+            with col2:
+                st.write(f"₹{amount:,.2f}")
+            total_expenses += amount
         
         st.markdown("---")
         col1, col2 = st.columns([3, 1])
@@ -2498,10 +4085,8 @@ elif menu == "📑 Financial Reports":
         
         # Customer Dues (Receivable)
         receivable = 0
-        if not customer_df.empty and len(customer_df.columns) >= 2:
-            cust_copy = customer_df.copy()
-            cust_copy.iloc[:, 1] = pd.to_numeric(cust_copy.iloc[:, 1], errors='coerce').fillna(0)
-            cust_dues = cust_copy.groupby(cust_copy.columns[0])[cust_copy.columns[1]].sum()
+        if not customer_df.empty:
+            cust_dues = customer_df.groupby('Customer')['Amount'].sum()
             receivable = cust_dues[cust_dues > 0].sum()
         
         col1, col2 = st.columns([3, 1])
@@ -2511,13 +4096,7 @@ elif menu == "📑 Financial Reports":
             st.write(f"₹{receivable:,.2f}")
         
         # Inventory
-        inventory_val = 0
-        if not inv_df.empty and len(inv_df.columns) > 3:
-            latest = inv_df.groupby(inv_df.iloc[:, 0]).tail(1)
-            latest['qty'] = pd.to_numeric(latest.iloc[:, 1], errors='coerce').fillna(0)
-            latest['rate'] = pd.to_numeric(latest.iloc[:, 3], errors='coerce').fillna(0)
-            latest['total'] = latest['qty'] * latest['rate']
-            inventory_val = latest['total'].sum()
+        inventory_val = current_stock_table()['Value'].sum()
         
         col1, col2 = st.columns([3, 1])
         with col1:
@@ -2541,10 +4120,8 @@ elif menu == "📑 Financial Reports":
         
         # Supplier Dues (Payable)
         payable = 0
-        if not supplier_df.empty and len(supplier_df.columns) >= 2:
-            supp_copy = supplier_df.copy()
-            supp_copy.iloc[:, 1] = pd.to_numeric(supp_copy.iloc[:, 1], errors='coerce').fillna(0)
-            supp_dues = supp_copy.groupby(supp_copy.columns[0])[supp_copy.columns[1]].sum()
+        if not supplier_df.empty:
+            supp_dues = supplier_df.groupby('Supplier')['Amount'].sum()
             payable = supp_dues[supp_dues > 0].sum()
         
         col1, col2 = st.columns([3, 1])
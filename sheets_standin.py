@@ -0,0 +1,305 @@
+"""Local stand-in for the shop's Google spreadsheet.
+
+SheetStore keeps every sheet in SQLite and answers the same requests the app
+makes of Google: gviz CSV reads (including the `select * offset N` and
+date-range `sum` queries) and the Apps Script POST actions. Run this file to
+serve it over HTTP so the app can be load-tested offline:
+
+    python sheets_standin.py --port 8765 --latency 0.4 --drop-rate 0.1
+    LAIKA_BACKEND=standin streamlit run "python shop.py"
+"""
+import argparse
+import csv
+import io
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+from contextlib import closing
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+OFFSET_QUERY = re.compile(r"select \* offset (\d+)$")
+SUM_QUERY = re.compile(
+    r"select (?:([A-Z]+), )?sum\(([A-Z]+)\) "
+    r"where ([A-Z]+) >= date '(\d{4}-\d{2}-\d{2})' and \3 <= date '(\d{4}-\d{2}-\d{2})'"
+    r"(?: group by \1)? label sum\(\2\) 'total'$"
+)
+
+
+def column_letter(col_idx):
+    """Spreadsheet letter(s) for a 0-based column position"""
+    letters = ""
+    col_idx += 1
+    while col_idx:
+        col_idx, rem = divmod(col_idx - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def column_index(letters):
+    """0-based column position for spreadsheet letter(s)"""
+    idx = 0
+    for ch in letters:
+        idx = idx * 26 + ord(ch) - 64
+    return idx - 1
+
+
+def parse_date(value):
+    """Read a date cell the way Sheets would (dd/mm/yyyy or ISO), or None"""
+    for fmt in ("%d/%m/%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(str(value).strip(), fmt).date()
+        except ValueError:
+            pass
+    return None
+
+
+def to_number(value):
+    """Numeric value of a cell, or None for text and blanks"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SheetStore:
+    """Spreadsheet rows kept in SQLite, one JSON list per row"""
+
+    def __init__(self, path, headers=None):
+        self.path = path
+        self.headers = headers or {}
+        self.lock = threading.Lock()
+        with closing(self.connect()) as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS sheet_rows (
+                sheet TEXT, idx INTEGER, data TEXT, PRIMARY KEY (sheet, idx))""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS applied_keys (
+                idem_key TEXT PRIMARY KEY, reply TEXT, applied_at REAL)""")
+            conn.commit()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def rows(self, sheet_name):
+        """All data rows of a sheet, oldest first"""
+        with closing(self.connect()) as conn:
+            found = conn.execute("SELECT data FROM sheet_rows WHERE sheet = ? ORDER BY idx", (sheet_name,))
+            return [json.loads(data) for (data,) in found]
+
+    def header(self, sheet_name, rows):
+        """Header row: the configured names, else column letters - at least one
+        column, as Google sends a header row even for an empty sheet"""
+        width = max([len(row) for row in rows] + [len(self.headers.get(sheet_name, [])), 1])
+        names = list(self.headers.get(sheet_name, []))
+        return names + [column_letter(i) for i in range(len(names), width)]
+
+    def append(self, sheet_name, new_rows, conn):
+        """Append rows at the bottom of a sheet inside an open transaction"""
+        last = conn.execute("SELECT COALESCE(MAX(idx), -1) FROM sheet_rows WHERE sheet = ?", (sheet_name,)).fetchone()[0]
+        conn.executemany("INSERT INTO sheet_rows VALUES (?, ?, ?)",
+                         [(sheet_name, last + 1 + i, json.dumps(row)) for i, row in enumerate(new_rows)])
+
+    def sheet(self, sheet_name, conn):
+        """All data rows of a sheet, read inside an open transaction"""
+        found = conn.execute("SELECT data FROM sheet_rows WHERE sheet = ? ORDER BY idx", (sheet_name,))
+        return [json.loads(data) for (data,) in found]
+
+    def stock_levels(self, conn):
+        """Current stock per item: the latest StockSnapshots set (or, before the first
+        snapshot, each item's last Inventory row dated before the ledger's first
+        movement - later rows are purchase lots) plus the StockLedger rows after it"""
+        snapshots = [row for row in self.sheet("StockSnapshots", conn) if len(row) > 3]
+        ledger = self.sheet("StockLedger", conn)
+        if snapshots:
+            covered = max(int(to_number(row[3]) or 0) for row in snapshots)
+            stock = {str(row[1]).strip().upper(): to_number(row[2]) or 0
+                     for row in snapshots if int(to_number(row[3]) or 0) == covered}
+        else:
+            covered = 0
+            started = min((day for day in (parse_date(row[0]) for row in ledger) if day), default=None)
+            stock = {}
+            for row in self.sheet("Inventory", conn):
+                day = parse_date(row[4]) if len(row) > 4 else None
+                if len(row) > 1 and (not ledger or (day and started and day < started)):
+                    stock[str(row[0]).strip().upper()] = to_number(row[1]) or 0
+        for row in ledger[covered:]:
+            key = str(row[1]).strip().upper()
+            stock[key] = stock.get(key, 0) + (to_number(row[2]) or 0)
+        return stock
+
+    # --- gviz reads ---
+    def read_csv(self, sheet_name, query=None):
+        """Answer a gviz CSV request - raises ValueError for queries it can't run"""
+        rows = self.rows(sheet_name)
+        out = io.StringIO()
+        writer = csv.writer(out)
+        query = (query or "").strip()
+
+        if not query:
+            writer.writerow(self.header(sheet_name, rows))
+            writer.writerows(rows)
+            return out.getvalue()
+
+        match = OFFSET_QUERY.match(query)
+        if match:
+            writer.writerow(self.header(sheet_name, rows))
+            writer.writerows(rows[int(match.group(1)):])
+            return out.getvalue()
+
+        match = SUM_QUERY.match(query)
+        if match:
+            group_col, sum_col, date_col, date_from, date_to = match.groups()
+            date_from, date_to = parse_date(date_from), parse_date(date_to)
+            sum_idx, date_idx = column_index(sum_col), column_index(date_col)
+            group_idx = column_index(group_col) if group_col else None
+            totals = {}
+            for row in rows:
+                cells = row + [None] * (max(sum_idx, date_idx, group_idx or 0) + 1 - len(row))
+                day = parse_date(cells[date_idx])
+                if day is None or not date_from <= day <= date_to:
+                    continue
+                value = to_number(cells[sum_idx])
+                if value is None:
+                    raise ValueError(f"Column {sum_col} holds text")
+                key = cells[group_idx] if group_idx is not None else None
+                totals[key] = totals.get(key, 0) + value
+
+            if group_idx is None:
+                writer.writerow(["total"])
+                writer.writerow([totals.get(None, 0)])
+            else:
+                writer.writerow([group_col, "total"])
+                writer.writerows(totals.items())
+            return out.getvalue()
+
+        raise ValueError(f"Unsupported query: {query}")
+
+    # --- Apps Script writes ---
+    def handle_post(self, payload, sheet_name=None, idem_key=None):
+        """Answer an Apps Script POST with the same reply text the script sends.
+        A request repeating the idem_key of an applied request gets the first reply
+        and changes nothing; rejected requests don't use up their key."""
+        with self.lock, closing(self.connect()) as conn:
+            # Hold the write lock from the first read, so other processes can't interleave
+            conn.execute("BEGIN IMMEDIATE")
+            if idem_key:
+                seen = conn.execute("SELECT reply FROM applied_keys WHERE idem_key = ?", (idem_key,)).fetchone()
+                if seen:
+                    conn.rollback()
+                    return seen[0]
+
+            reply = self.apply(payload, sheet_name, conn)
+            if reply.startswith("ERROR"):
+                # Nothing changed, so a later retry with this key is free to apply
+                conn.rollback()
+                return reply
+            if idem_key:
+                conn.execute("INSERT INTO applied_keys VALUES (?, ?, ?)", (idem_key, reply, time.time()))
+            # The write and its key are committed together
+            conn.commit()
+            return reply
+
+    def apply(self, payload, sheet_name, conn):
+        """Carry out one POST inside an open transaction, returning the reply text"""
+        if sheet_name:
+            self.append(sheet_name, [payload], conn)
+            return "Success"
+
+        action = payload.get("action")
+        if action == "batch_append":
+            for write in payload.get("writes", []):
+                self.append(write["sheet"], write["rows"], conn)
+            return "Success"
+
+        if action == "apply_stock_deltas":
+            # Movements checked against current stock and appended to the ledger together
+            stock = self.stock_levels(conn)
+            movements = []
+            for item_name, delta in payload.get("deltas", {}).items():
+                key = str(item_name).strip().upper()
+                if key not in stock:
+                    return f"ERROR: Item not found: {item_name}"
+                if stock[key] + float(delta) < 0:
+                    return f"ERROR: Insufficient stock for {item_name}"
+                movements.append([payload.get("date") or datetime.now().strftime("%d/%m/%Y"), item_name,
+                                  float(delta), payload.get("kind", ""), payload.get("ref", ""), payload.get("user", "")])
+            self.append("StockLedger", movements, conn)
+            return "SUCCESS"
+
+        return f"ERROR: Unknown action {action}"
+
+
+def make_handler(store, latency, drop_rate=0.0):
+    """HTTP handler serving a SheetStore on the gviz and Apps Script paths.
+    drop_rate is the share of POSTs applied but then answered by a dropped connection."""
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def reply(self, status, body, content_type):
+            data = body.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            time.sleep(latency)
+            url = urllib.parse.urlparse(self.path)
+            params = urllib.parse.parse_qs(url.query)
+            if url.path != "/gviz/tq" or "sheet" not in params:
+                return self.reply(404, "Not found", "text/plain")
+            try:
+                body = store.read_csv(params["sheet"][0], params.get("tq", [None])[0])
+            except ValueError as e:
+                # Google answers bad queries with a non-CSV error page
+                return self.reply(200, json.dumps({"status": "error", "message": str(e)}), "application/json")
+            self.reply(200, body, "text/csv; charset=utf-8")
+
+        def do_POST(self):
+            time.sleep(latency)
+            url = urllib.parse.urlparse(self.path)
+            params = urllib.parse.parse_qs(url.query)
+            if url.path != "/exec":
+                return self.reply(404, "Not found", "text/plain")
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                payload = json.loads(self.rfile.read(length) or b"null")
+                body = store.handle_post(payload, params.get("sheet", [None])[0], params.get("key", [None])[0])
+            except Exception as e:
+                body = f"ERROR: {e}"
+            if random.random() < drop_rate:
+                # The write landed but the client never hears back
+                self.close_connection = True
+                return
+            self.reply(200, body, "text/plain")
+
+        def log_message(self, format, *args):
+            pass
+
+    return StandInHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the shop spreadsheet")
+    parser.add_argument("--db", default="laika_standin.db", help="SQLite file holding the sheets")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Share of writes whose reply is lost")
+    args = parser.parse_args()
+
+    handler = make_handler(SheetStore(args.db), args.latency, args.drop_rate)
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print(f"Sheets stand-in on http://{args.host}:{args.port} (db={args.db}, latency={args.latency}s)")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
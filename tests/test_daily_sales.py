@@ -0,0 +1,67 @@
+"""get_daily_sales across a shop's first bills.
+
+The app is a single Streamlit script, so the functions under test are taken
+from its source and run against stand-ins for the sheet loaders.
+"""
+import ast
+import threading
+from datetime import date
+from pathlib import Path
+
+import pandas as pd
+
+SHOP_SOURCE = Path(__file__).resolve().parent.parent / "python shop.py"
+
+
+def load_functions(*names, **namespace):
+    """Compile the named top-level functions of the shop script into a namespace"""
+    tree = ast.parse(SHOP_SOURCE.read_text(encoding="utf-8"))
+    wanted = [node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name in names]
+    namespace.setdefault("pd", pd)
+    exec(compile(ast.Module(body=wanted, type_ignores=[]), str(SHOP_SOURCE), "exec"), namespace)
+    return namespace
+
+
+def bills(*rows):
+    return pd.DataFrame(rows, columns=["Date", "Customer", "Phone", "Item", "Qty", "Rate", "Amount", "BillID"])
+
+
+def make_shop():
+    sheets = {"Bills": pd.DataFrame()}
+    cache = {"lock": threading.Lock(), "daily_sales": {"rows": 0, "last_row": None, "daily": None}}
+    shop = load_functions("get_daily_sales", "normalize_item",
+                          load_data=lambda name: sheets[name], get_sheet_cache=lambda: cache)
+    return shop, sheets
+
+
+def test_empty_bills_then_first_bills():
+    shop, sheets = make_shop()
+    assert shop["get_daily_sales"]().empty
+
+    sheets["Bills"] = bills()
+    assert shop["get_daily_sales"]().empty
+
+    first = (date(2026, 10, 1), "A", "1", "Chew Bone", 2.0, 50.0, 100.0, "B1")
+    sheets["Bills"] = bills(first)
+    daily = shop["get_daily_sales"]()
+    assert daily[("CHEW BONE", date(2026, 10, 1))] == 2.0
+
+    # The next bill is folded into the running totals
+    second = (date(2026, 10, 1), "B", "2", "chew bone ", 1.0, 50.0, 50.0, "B2")
+    sheets["Bills"] = bills(first, second)
+    daily = shop["get_daily_sales"]()
+    assert daily[("CHEW BONE", date(2026, 10, 1))] == 3.0
+    assert len(daily) == 1
+
+
+def test_failed_load_keeps_running_totals():
+    shop, sheets = make_shop()
+    row = (date(2026, 10, 2), "A", "1", "Pedigree", 1.0, 900.0, 900.0, "B1")
+    sheets["Bills"] = bills(row)
+    shop["get_daily_sales"]()
+
+    sheets["Bills"] = pd.DataFrame()
+    assert shop["get_daily_sales"]().empty
+
+    sheets["Bills"] = bills(row, row)
+    assert shop["get_daily_sales"]()[("PEDIGREE", date(2026, 10, 2))] == 2.0